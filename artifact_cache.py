@@ -0,0 +1,126 @@
+import hashlib
+import os
+from pathlib import Path
+import shutil
+from subprocess import run
+import tempfile
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+_digest_lock = threading.Lock()
+_digests: Dict[Tuple[str, int, int], str] = {}
+
+# The umask can only be read by changing it, which is not thread-safe, so it is
+# read once, on import
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def file_digest(path: Path) -> str:
+    """SHA-256 of the given file, memoized on path, size and mtime. Returns
+    an empty string if the file does not exist."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return ""
+    memo_key = (str(path), st.st_size, st.st_mtime_ns)
+    with _digest_lock:
+        if memo_key in _digests:
+            return _digests[memo_key]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    with _digest_lock:
+        _digests[memo_key] = h.hexdigest()
+    return h.hexdigest()
+
+
+def inputs_digest(inputs: Iterable[str]) -> str:
+    h = hashlib.sha256()
+    for item in inputs:
+        data = item.encode()
+        h.update(len(data).to_bytes(8, "little"))
+        h.update(data)
+    return h.hexdigest()
+
+
+def compressor():
+    if shutil.which("zstd"):
+        return ".tar.zst", ["-I", "zstd -T0"]
+    return ".tar.gz", ["-z"]
+
+
+def staging_links(base_dir: Path, name: str) -> List[str]:
+    """Symbolic links in the staging directory that point to the given
+    package directory (e.g. python3.11 -> Python-3.11.10)."""
+    if not base_dir.is_dir():
+        return []
+    return sorted(p.name for p in base_dir.iterdir()
+                  if p.is_symlink() and os.readlink(p) == name)
+
+
+def is_external_link(path: Path) -> bool:
+    """Whether the given entry of a staging directory is a link to a
+    directory outside of it, e.g. the toolchain in the shared store."""
+    return path.is_symlink() and os.path.isabs(os.readlink(path))
+
+
+class ArtifactCache:
+    """Stores staged directories as compressed archives, keyed by a hash of
+    all inputs of the recipe that produced them. The cache directory can be
+    shared between checkouts and machines (e.g. on a network drive)."""
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def _candidates(self, key: str):
+        d = self.root / key[:2]
+        return [(d / f"{key}.tar.zst", ["-I", "zstd -d"]),
+                (d / f"{key}.tar.gz", ["-z"])]
+
+    def lookup(self, key: str) -> Optional[Path]:
+        for path, _ in self._candidates(key):
+            if path.exists():
+                return path
+        return None
+
+    def restore(self, key: str, base_dir: Path, members: List[str]) -> bool:
+        for path, flags in self._candidates(key):
+            if not path.exists():
+                continue
+            if flags[0] == "-I" and not shutil.which("zstd"):
+                continue
+            base_dir.mkdir(parents=True, exist_ok=True)
+            for m in members:
+                p = base_dir / m
+                if p.is_symlink() or p.is_file():
+                    p.unlink()
+                elif p.exists():
+                    shutil.rmtree(p)
+            run(["tar", "-x", *flags, "-f", str(path), "-C", str(base_dir)],
+                check=True)
+            return True
+        return False
+
+    def store(self, key: str, base_dir: Path, members: List[str]):
+        ext, flags = compressor()
+        dest = self.root / key[:2] / f"{key}{ext}"
+        if dest.exists():
+            return dest
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first, so concurrent readers never see a
+        # partial archive
+        fd, tmp = tempfile.mkstemp(dir=dest.parent, suffix=ext + ".tmp")
+        os.close(fd)
+        try:
+            run(["tar", "-c", *flags, "-f", tmp, "-C", str(base_dir), *members],
+                check=True)
+            # mkstemp creates the file as readable by its owner only, but the
+            # cache may be shared with other users
+            os.chmod(tmp, 0o666 & ~_umask)
+            os.replace(tmp, dest)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        return dest
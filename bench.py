@@ -0,0 +1,281 @@
+import argparse
+import datetime
+import json
+import os
+from pathlib import Path
+import platform
+import shutil
+from statistics import median
+from subprocess import DEVNULL, PIPE, run
+import sys
+import sysconfig
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from build import (CACHEABLE_TARGETS, DEF_PYTHON_VERSIONS, NOARCH,
+                   MakefileBuilder)
+from ccache import CCACHE_DIR_ENV
+from platform_config import PlatformConfig
+
+this_dir = Path(__file__).parent
+
+BENCH_TRIPLES = ["x86_64-centos7-linux-gnu", "aarch64-rpi3-linux-gnu"]
+BENCH_PYTHON = DEF_PYTHON_VERSIONS[-1]
+BENCH_PACKAGES = ["googletest", "fftw", "eigen"]
+
+# Scenarios, in the order in which they are run: a build from scratch with an
+# empty ccache, a build from scratch with the ccache filled by the previous
+# build, and a rebuild without any changes.
+SCENARIOS = ["cold", "warm-ccache", "no-op"]
+
+CMAKE_PROJECT = """\
+cmake_minimum_required(VERSION 3.16)
+project(bench C CXX)
+"""
+
+
+def staged_dirs(triple: str) -> List[Path]:
+    """The staging directories (and the symlinks to them) of the benchmarked
+    targets."""
+    plat = PlatformConfig.from_string(triple)
+    builder = MakefileBuilder(sysconfig.get_config_var('HOST_GNU_TYPE'), [])
+    targets = ["zlib", "python"] + BENCH_PACKAGES
+    variables = [CACHEABLE_TARGETS[t][1] for t in targets]
+    dirs = [this_dir / d for d in builder.query(BENCH_PYTHON, plat, variables)]
+    links = []
+    for d in dirs:
+        if d.parent.is_dir():
+            links += [p for p in d.parent.iterdir()
+                      if p.is_symlink() and os.readlink(p) == d.name]
+    return dirs + links
+
+
+def remove_sources(src_dir: Path):
+    """Remove the extracted source trees, which are read-only (see extract in
+    the Makefile)."""
+    for root, dirs, _ in os.walk(src_dir):
+        for d in dirs:
+            path = Path(root) / d
+            if not path.is_symlink():
+                path.chmod(path.stat().st_mode | 0o200)
+    shutil.rmtree(src_dir, ignore_errors=True)
+
+
+def clean(triples: List[str], ccache_dir: Optional[Path]):
+    """Remove everything that the benchmarked targets build (but not the
+    toolchains), and optionally the ccache."""
+    for triple in triples:
+        for p in staged_dirs(triple):
+            if p.is_symlink() or p.is_file():
+                p.unlink()
+            elif p.exists():
+                shutil.rmtree(p)
+        shutil.rmtree(this_dir / "build" / triple, ignore_errors=True)
+    shutil.rmtree(this_dir / "build" / NOARCH, ignore_errors=True)
+    remove_sources(this_dir / "build" / "src")
+    if ccache_dir is not None:
+        shutil.rmtree(ccache_dir, ignore_errors=True)
+
+
+def time_build(args, env: dict, trace: Path, durations: Path) -> float:
+    cmd = [sys.executable, str(this_dir / "build.py"), "-j", str(args.jobs)]
+    cmd += [a for t in args.host for a in ("--host", t)]
+    cmd += ["--py", str(BENCH_PYTHON)]
+    cmd += [a for p in BENCH_PACKAGES for a in ("--package", p)]
+    cmd += ["--mirror", str(args.mirror), "--trace", str(trace)]
+    # Keep the durations of real builds (build.py --durations) unaffected
+    cmd += ["--durations", str(durations)]
+    start = time.perf_counter()
+    run(cmd, check=True, env=env, stdout=None if args.verbose else DEVNULL)
+    return time.perf_counter() - start
+
+
+def time_cmake_configure(triple: str, repeat: int) -> float:
+    """Median time it takes to configure a trivial CMake project using the
+    generated toolchain file."""
+    toolchain = this_dir / "staging" / triple / f"{triple}.toolchain.cmake"
+    generator = ["-G", "Ninja"] if shutil.which("ninja") else []
+    times = []
+    with tempfile.TemporaryDirectory() as tmp:
+        src = Path(tmp) / "src"
+        src.mkdir()
+        (src / "CMakeLists.txt").write_text(CMAKE_PROJECT)
+        for i in range(repeat):
+            cmd = ["cmake", "-S", str(src), "-B", str(Path(tmp) / f"build{i}")]
+            cmd += generator + [f"-DCMAKE_TOOLCHAIN_FILE={toolchain}"]
+            start = time.perf_counter()
+            run(cmd, check=True, stdout=DEVNULL)
+            times.append(time.perf_counter() - start)
+    return median(times)
+
+
+def git_revision() -> str:
+    res = run(["git", "rev-parse", "HEAD"], cwd=this_dir, stdout=PIPE,
+              stderr=DEVNULL, universal_newlines=True)
+    return res.stdout.strip() if res.returncode == 0 else ""
+
+
+def run_benchmarks(args) -> dict:
+    bench_dir = this_dir / "build" / "bench"
+    ccache_dir = bench_dir / "ccache"
+    env = dict(os.environ, CCACHE_DIR=str(ccache_dir))
+    # build.py --ccache-dir would otherwise use the user's (warm) ccache
+    env.pop(CCACHE_DIR_ENV, None)
+    env.pop("CROSS_PYTHON_CACHE", None)
+    results: Dict[str, float] = {}
+    for scenario in SCENARIOS:
+        if scenario == "cold":
+            clean(args.host, ccache_dir)
+        elif scenario == "warm-ccache":
+            clean(args.host, None)
+        print(f"Running the {scenario} build")
+        trace = bench_dir / f"{scenario}.trace.json"
+        results[scenario] = time_build(args, env, trace,
+                                       bench_dir / "durations.json")
+    for triple in args.host:
+        print(f"Configuring a CMake project for {triple}")
+        results[f"cmake-configure/{triple}"] = \
+            time_cmake_configure(triple, args.repeat)
+    return {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "machine": platform.node(),
+        "config": {
+            "triples": args.host,
+            "python": str(BENCH_PYTHON),
+            "packages": BENCH_PACKAGES,
+            "jobs": args.jobs,
+        },
+        "results": results,
+    }
+
+
+def load_history(path: Path) -> List[dict]:
+    return json.loads(path.read_text()) if path.exists() else []
+
+
+def write_json(path: Path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(data, indent=2) + "\n")
+    os.replace(tmp, path)
+
+
+def compare(current: dict, baseline: dict, threshold: float,
+            tolerance: float) -> bool:
+    """Print the results next to the baseline. Returns False if any result is
+    more than ``threshold`` (relative) and ``tolerance`` (in seconds) slower
+    than the baseline."""
+    ok = True
+    print(f"Baseline: {baseline.get('revision', '')[:12]} "
+          f"({baseline.get('date', '')})")
+    print(f"{'':30} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, value in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name:30} {'-':>10} {value:9.2f}s")
+            continue
+        change = (value - base) / base if base > 0 else 0.0
+        slower = value > base * (1 + threshold) and value - base > tolerance
+        ok = ok and not slower
+        print(f"{name:30} {base:9.2f}s {value:9.2f}s {change:+8.1%}"
+              f"{'  FAIL' if slower else ''}")
+    return ok
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="build.py bench",
+        description="Benchmark a scaled-down build matrix",
+        allow_abbrev=False,
+    )
+    parser.add_argument(
+        "--mirror",
+        type=Path,
+        required=True,
+        help="Directory with all source archives (downloads are not part of "
+        "the benchmark)",
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        action='append',
+        help="GNU triples to build (default: " + ", ".join(BENCH_TRIPLES) +
+        ")",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=2,
+        help="Number of parallel jobs",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="Number of times to configure the CMake project",
+    )
+    parser.add_argument(
+        "--history",
+        type=Path,
+        default=this_dir / "build" / "bench-history.json",
+        help="JSON file to which the results are appended",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        help="JSON file with the baseline results (default: the latest "
+        "entry in the history with the same configuration)",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action='store_true',
+        help="Write the results to the --baseline file",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Maximum relative slowdown compared to the baseline",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.0,
+        help="Slowdowns of fewer seconds than this are never regressions",
+    )
+    parser.add_argument(
+        "--verbose",
+        "-v",
+        action='store_true',
+        help="Show the output of the builds",
+    )
+    args = parser.parse_args(argv)
+    args.host = args.host or BENCH_TRIPLES
+    if args.save_baseline and args.baseline is None:
+        parser.error("--save-baseline requires --baseline")
+
+    current = run_benchmarks(args)
+    history = load_history(args.history)
+    if args.baseline is not None and args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())
+    else:
+        same = [h for h in history if h["config"] == current["config"]]
+        baseline = same[-1] if same else None
+    write_json(args.history, history + [current])
+    if args.save_baseline:
+        write_json(args.baseline, current)
+
+    if baseline is None:
+        print("No baseline to compare to")
+        for name, value in current["results"].items():
+            print(f"{name:30} {value:9.2f}s")
+        return
+    if not compare(current, baseline, args.threshold, args.tolerance):
+        sys.exit("Benchmark results are slower than the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,30 @@
 import argparse
 import dataclasses
+from functools import partial
 from itertools import product
-from multiprocessing.pool import Pool
+from multiprocessing.pool import ThreadPool
 import os
 import re
-from subprocess import run
+from subprocess import PIPE, CalledProcessError, run
 import sys
 import sysconfig
-from typing import List, Optional
-from platform_config import PlatformConfig
+import time
+from typing import Dict, List, Optional, Union
+from platform_config import (PlatformConfig, fftw_quad, known_platforms,
+                             openblas_dynamic_target, platform_info,
+                             toolchain_triple)
 from pathlib import Path
+from artifact_cache import (ArtifactCache, file_digest, inputs_digest,
+                            staging_links)
+from ccache import CCACHE_DIR_ENV, CcacheConfig
+from download import (CHECKSUMS_FILE, UNPINNED, UNVERIFIABLE, Download,
+                      Downloader, lookup_checksum, read_checksums,
+                      write_checksums)
+import gen_configs
+from remote import WorkerPool
+from scheduler import Scheduler, Skipped
+from timing import (DurationDB, JobRecord, Recorder, ccache_summary,
+                    run_timed)
 
 this_dir = Path(__file__).parent
 
@@ -21,6 +36,7 @@ class PythonVersion:
     patch: int
     suffix: str = ""
     executable: Optional[str] = None
+    flavour: str = ""  # Variant of the CPython build, see PYTHON_FLAVOURS
 
     @classmethod
     def current_version(cls):
@@ -38,6 +54,9 @@ class PythonVersion:
         m = re.match(r'^(\d+).(\d+).(\d+)((?:a|b|rc)\d+)?$', s)
         return cls(*m.groups(default=""))
 
+    def __str__(self):
+        return f"{self.major}.{self.minor}.{self.patch}{self.suffix}"
+
 
 DEF_PLATFORMS = [
     PlatformConfig("x86_64", "centos7", "linux", "gnu"),
@@ -57,6 +76,18 @@ DEF_PYTHON_VERSIONS = [
     PythonVersion(3, 13, 0),
 ]
 
+# Variants of the CPython build (PYTHON_FLAVOUR in the Makefile). The default
+# one is staged as e.g. python3.11, the others as e.g. python3.11-optimized
+# (except for the free-threaded one, python3.13t).
+PYTHON_FLAVOURS = {
+    "default": "",
+    "optimized": "optimized",  # LTO, tuned for the host CPU, PGO if available
+    "freethreaded": "freethreaded",  # Without the GIL (PEP 703)
+}
+
+# First version of CPython that can be built without the GIL
+FREE_THREADED_MIN_VERSION = (3, 13)
+
 DEF_PYPY_VERSIONS = [
     PythonVersion(3, 7, 99),
     PythonVersion(3, 8, 99),
@@ -67,6 +98,10 @@ DEF_PYPY_VERSIONS = [
 def is_pypy_platform(plat: PlatformConfig):
     return plat.cpu in ('x86_64', 'aarch64')
 
+
+def is_dynamic_blas_platform(plat: PlatformConfig):
+    return bool(openblas_dynamic_target(plat))
+
 DEF_PACKAGES = [
     "py-build-cmake",
     "conan",
@@ -88,22 +123,220 @@ DEF_PACKAGES = [
     "suitesparse",
 ]
 
+# Dependencies between the Makefile targets for a single host triple. Targets
+# that are not listed only depend on the toolchain and the CMake toolchain file.
+TARGET_DEPENDENCIES = {
+    "toolchain": [],
+    "cmake": ["toolchain"],
+    "zlib": ["toolchain"],
+    "python": ["zlib"],
+    "pypy": [],
+    "py-build-cmake": ["cmake"],
+    "conan": ["cmake"],
+    "mumps": ["toolchain", "openblas"],
+    "ipopt": ["toolchain", "mumps"],
+    "suitesparse": ["toolchain", "cmake", "openblas"],
+}
+DEFAULT_TARGET_DEPENDENCIES = ["toolchain", "cmake"]
+
+# Targets that are built once per Python version
+VERSIONED_TARGETS = ["python", "pypy"]
+
+# Variants of OpenBLAS (BLAS_FLAVOUR in the Makefile), and the targets that are
+# built once per variant, against the OpenBLAS of that variant. The default
+# ones are staged as e.g. openblas, the others as e.g. openblas-dynamic.
+BLAS_FLAVOURS = {
+    "default": "",
+    "dynamic": "dynamic",  # Kernels for several CPUs, selected at run time
+}
+BLAS_TARGETS = ["openblas", "mumps", "ipopt", "suitesparse"]
+
+# Architecture-independent targets, which are built once in staging/noarch
+# (make noarch-<target>) and linked into the staging directory of every host
+NOARCH = "noarch"
+NOARCH_TARGETS = [
+    "eigen",
+    "eigen-master",
+    "pybind11",
+    "pybind11-2.11.1",
+    "pybind11-2.13.6",
+    "pybind11-cross",
+    "pybind11-master",
+    "nanobind",
+]
+
+# Number of CPU tokens each target gets from the global budget (--cpus), at
+# least. Every job also gets at least its fair share of the budget
+# (cpus / jobs). The target's inner make/CMake builds use this many jobs.
+TARGET_WEIGHTS = {
+    "toolchain": 1,
+    "cmake": 1,
+    "zlib": 1,
+    "python": 4,
+    "pypy": 1,
+    "py-build-cmake": 1,
+    "conan": 1,
+    "nanobind": 1,
+    "fftw": 4,
+    "googletest": 2,
+    "casadi": 8,
+    "flang": 8,
+    "openblas": 6,
+    "mumps": 2,
+    "ipopt": 4,
+    "suitesparse": 4,
+}
+DEFAULT_TARGET_WEIGHT = 1
+
+# Predicted duration of jobs for targets that were never built before (s)
+DEFAULT_JOB_DURATION = 60.0
+
+
+# Packages whose staged output can be stored in the artifact cache, with the
+# title of their section in the Makefile, and the Makefile variables with their
+# staging directory, the file that marks them as up to date, and their source
+# archive.
+CACHEABLE_TARGETS = {
+    "zlib": ("Zlib", "ZLIB_STAGING_DIR", "ZLIB_INC", "ZLIB_TGZ"),
+    "python": ("Python", "PY_STAGING_DIR", "PYTHON_BIN", "PYTHON_TGZ"),
+    "fftw": ("FFTW", "FFTW_STAGING_DIR", "FFTW_INC", "FFTW_TGZ"),
+    "eigen": ("Eigen", "EIGEN_STAGING_DIR", "EIGEN_INC", "EIGEN_TGZ"),
+    "eigen-master": ("Eigen master", "EIGEN_MASTER_STAGING_DIR",
+                     "EIGEN_MASTER_INC", "EIGEN_MASTER_TGZ"),
+    "googletest": ("GTest", "GTEST_STAGING_DIR", "GTEST_INC", "GTEST_TGZ"),
+    "casadi": ("CasADi", "CASADI_STAGING_DIR", "CASADI_INC", "CASADI_TGZ"),
+    "pybind11": ("pybind11", "PYBIND11_STAGING_DIR", "PYBIND11_INC",
+                 "PYBIND11_TGZ"),
+    "pybind11-2.11.1": ("pybind11-2.11.1", "PYBIND11_2_11_STAGING_DIR",
+                        "PYBIND11_2_11_INC", "PYBIND11_2_11_TGZ"),
+    "pybind11-2.13.6": ("pybind11-2.13.6", "PYBIND11_2_13_STAGING_DIR",
+                        "PYBIND11_2_13_INC", "PYBIND11_2_13_TGZ"),
+    "pybind11-cross": ("pybind11-cross", "PYBIND11_CROSS_STAGING_DIR",
+                       "PYBIND11_CROSS_INC", "PYBIND11_CROSS_TGZ"),
+    "pybind11-master": ("pybind11-master", "PYBIND11_MASTER_STAGING_DIR",
+                        "PYBIND11_MASTER_INC", "PYBIND11_MASTER_TGZ"),
+    "nanobind": ("nanobind", "NANOBIND_STAGING_DIR", "NANOBIND_CONFIG", None),
+    "flang": ("Flang runtime", "FLANG_STAGING_DIR", "FLANG_LIB", "FLANG_TGZ"),
+    "openblas": ("OpenBLAS", "OpenBLAS_STAGING_DIR", "OpenBLAS_INC",
+                 "OpenBLAS_TGZ"),
+    "mumps": ("MUMPS", "MUMPS_STAGING_DIR", "MUMPS_INC", "MUMPS_TGZ"),
+    "ipopt": ("Ipopt", "Ipopt_STAGING_DIR", "Ipopt_INC", "Ipopt_TGZ"),
+    "suitesparse": ("SuiteSparse", "SuiteSparse_STAGING_DIR",
+                    "SuiteSparse_INC", "SuiteSparse_TGZ"),
+}
+
+# Makefile variables with the source archives of each target
+TARGET_SOURCES = {
+    "toolchain": ["TOOLCHAIN_TXZ"],
+    "pypy": ["PYPY_TGZ"],
+}
+for _target, _info in CACHEABLE_TARGETS.items():
+    if _info[3] is not None:
+        TARGET_SOURCES.setdefault(_target, []).append(_info[3])
+
+# Other files that affect the result of a target
+TARGET_EXTRA_INPUTS = {
+    "python": ["config.site"],
+    "openblas": ["platform_config.py"],
+    "fftw": ["platform_config.py", "fftw-simd.cmake"],
+}
+
+# Makefile variables with other files that affect the result of a target, if
+# they exist
+TARGET_EXTRA_VARIABLES = {
+    "python": ["PY_PGO_USE"],
+}
+
+
+# Titles of the Makefile sections that are not cacheable packages. Together
+# with the titles in CACHEABLE_TARGETS, these start a new section; all other
+# comments belong to the section they are in.
+MAKEFILE_TITLES = ["Toolchain", "PyPy", "CMake toolchain", "Clean"]
+
+
+def makefile_sections() -> Dict[str, str]:
+    """Split the Makefile into sections, each running from the title comment
+    of one package to the title of the next. The section of each cacheable
+    target also includes the shared definitions at the top of the Makefile
+    and the toolchain rules, which are used by all recipes."""
+    titles = set(MAKEFILE_TITLES)
+    titles.update(info[0] for info in CACHEABLE_TARGETS.values())
+    sections: Dict[str, str] = {}
+    title, lines, prev = "", [], ""
+    for line in (this_dir / "Makefile").read_text().splitlines():
+        if line.startswith("# ") and line[2:].strip() in titles \
+                and not prev.strip():
+            sections[title] = "\n".join(lines)
+            title, lines = line[2:].strip(), []
+        lines.append(line)
+        prev = line
+    sections[title] = "\n".join(lines)
+    shared = sections[""] + "\n" + sections["Toolchain"]
+    for target, (title, _, marker_var, _) in CACHEABLE_TARGETS.items():
+        section = sections.get(title, "")
+        if not re.search(rf"^\$\({marker_var}\):", section, re.MULTILINE):
+            raise RuntimeError(f"Makefile section '{title}' does not contain "
+                               f"the recipe of {target} ($({marker_var}))")
+        sections[title] = shared + "\n" + section
+    return sections
+
+
+# Stages of a Makefile recipe that may fail because of network problems. Jobs
+# that fail in one of these stages are retried.
+TRANSIENT_STAGES = ["download", "extract"]
+RETRY_DELAY = 10  # seconds, doubled after every attempt
+
 
 class MakefileBuilder:
-    def __init__(self, build_triple: str, targets: List[str]):
+    def __init__(self, build_triple: str, targets: List[str], jobs: int = 1,
+                 recorder: Optional[Recorder] = None, key: tuple = (),
+                 log_dir: Optional[Path] = None, retries: int = 0,
+                 workers: Optional[WorkerPool] = None,
+                 blas_flavour: str = "",
+                 ccache: Optional[CcacheConfig] = None):
         self.build_triple = build_triple
         self.targets = targets
+        self.jobs = jobs
+        self.recorder = recorder
+        self.key = key
+        self.log_dir = log_dir
+        self.retries = retries
+        self.workers = workers
+        self.blas_flavour = blas_flavour
+        self.ccache = ccache
+        # Staged files and directories to fetch from the remote worker
+        self.outputs: List[str] = []
+        # Source archives that the remote worker downloads and verifies
+        # before building
+        self.downloads: List[Download] = []
 
-    def __call__(self, args):
-        py, platform = args
+    @property
+    def name(self):
+        return " ".join(filter(None, self.key))
+
+    @property
+    def log_file(self) -> Optional[Path]:
+        if self.log_dir is None:
+            return None
+        return self.log_dir / (self.name.replace(" ", "_") + ".log")
+
+    def options(self, py: PythonVersion, platform: PlatformConfig):
         if py.executable is None:
             py.executable = f"python{py.major}.{py.minor}"
         opts = [
             f"BUILD_TRIPLE={self.build_triple}",
             f"HOST_TRIPLE={platform}",
+            # Saves make from running platform_config.py to look these up
+            "TOOLCHAIN_TRIPLE=" + (str(platform) if platform == NOARCH
+                                   else toolchain_triple(platform)),
+            "FFTW_QUAD=" + ("" if platform == NOARCH
+                            else str(fftw_quad(platform))),
             f"PYTHON_VERSION={py.major}.{py.minor}.{py.patch}",
             f"PYTHON_SUFFIX={py.suffix}",
+            f"PYTHON_FLAVOUR={py.flavour}",
+            f"BLAS_FLAVOUR={self.blas_flavour}",
             f"BUILD_PYTHON={py.executable}",
+            f"JOBS={self.jobs}",
         ]
         if "pypy" in self.targets:
             versions = {
@@ -113,9 +346,376 @@ class MakefileBuilder:
                 "3.7": "7.3.9",
             }
             opts += ["PYPY_VERSION=" + versions[f"{py.major}.{py.minor}"]]
-        cmd = ["make", "-C", str(this_dir)] + self.targets + opts
-        print(cmd)
-        run(cmd, check=True)
+        return opts
+
+    def query(self, py: PythonVersion, platform: PlatformConfig,
+              variables: List[str]) -> List[str]:
+        """Get the values of the given Makefile variables."""
+        cmd = ["make", "-s", "-C", str(this_dir)]
+        cmd += [f"print-{v}" for v in variables]
+        cmd += self.options(py, platform)
+        res = run(cmd, check=True, stdout=PIPE, universal_newlines=True)
+        return res.stdout.splitlines()
+
+    def __call__(self, args, assume_old: Optional[List[str]] = None):
+        py, platform = args
+        assume_old = assume_old or []
+        opts = self.options(py, platform)
+        cmd = ["make", "-C", str(this_dir), f"-j{self.jobs}"]
+        cmd += [f"--assume-old={f}" for f in assume_old]
+        cmd += self.targets + opts
+        env = dict(os.environ, CMAKE_BUILD_PARALLEL_LEVEL=str(self.jobs))
+        if self.ccache is not None:
+            env.update(self.ccache.env(str(platform)))
+        if self.recorder is None:
+            print(cmd)
+            run(cmd, check=True, env=env)
+            return
+        stages = self.recorder.stages_file(self.name)
+        cmd += [f"BUILD_TRACE={stages}"]
+        log = self.log_file
+        if log is not None:
+            log.parent.mkdir(parents=True, exist_ok=True)
+            log.write_text(f"{cmd}\n")
+            print(f"Building {self.name} (log: {log})")
+        else:
+            print(cmd)
+        for attempt in range(self.retries + 1):
+            if log is None:
+                record = self.run_job(cmd, env, stages, py, platform,
+                                      assume_old)
+            else:
+                with open(log, "ab") as f:
+                    record = self.run_job(cmd, env, stages, py, platform,
+                                          assume_old, f)
+            self.recorder.add(self.key, record)
+            if record.ccache_hits or record.ccache_misses:
+                print(f"{self.name}: ccache " +
+                      ccache_summary(record.ccache_hits, record.ccache_misses))
+            if record.status == 0:
+                return
+            # Other stages may still have been running in parallel when the
+            # first one failed, so the last stage isn't necessarily the cause
+            failed = [s for s in record.stages if s.status != 0]
+            stage = min(failed, key=lambda s: s.end).name if failed else None
+            if attempt == self.retries or stage not in TRANSIENT_STAGES:
+                raise CalledProcessError(record.status, cmd)
+            delay = RETRY_DELAY * 2**attempt
+            print(f"{self.name} failed in the {stage} stage, "
+                  f"retrying in {delay} s")
+            time.sleep(delay)
+
+    def run_job(self, cmd: List[str], env: dict, stages: Path,
+                py: PythonVersion, platform: PlatformConfig,
+                assume_old: List[str], log=None) -> JobRecord:
+        if self.workers is None:
+            return run_timed(self.name, cmd, env, stages, log,
+                             ccache_log=stages.with_suffix(".ccache"))
+        # The worker has its own Python installation
+        if py.executable and os.path.isabs(py.executable):
+            executable = f"python{py.major}.{py.minor}"
+            py = dataclasses.replace(py, executable=executable)
+        return self.workers.run(self.name, str(platform), self.targets,
+                                self.options(py, platform), self.jobs,
+                                self.outputs, assume_old, log,
+                                self.downloads)
+
+
+class BuildGraph(Scheduler):
+    def __init__(self, build_triple: str, jobs: int, cpus: int,
+                 weights: Dict[str, int],
+                 cache: Optional[ArtifactCache] = None,
+                 recorder: Optional[Recorder] = None,
+                 log_dir: Optional[Path] = None, retries: int = 0,
+                 workers: Optional[WorkerPool] = None,
+                 ccache: Optional[CcacheConfig] = None,
+                 downloader: Optional[Downloader] = None):
+        super().__init__()
+        self.build_triple = build_triple
+        self.jobs = jobs
+        self.cpus = cpus
+        self.weights = weights
+        self.cache = cache
+        self.recorder = recorder
+        self.log_dir = log_dir
+        self.retries = retries
+        self.workers = workers
+        self.ccache = ccache
+        self.downloader = downloader
+        self.sections = makefile_sections() if cache else {}
+        # Cache keys and up-to-date markers of the finished cacheable nodes
+        self.cache_keys: Dict[tuple, str] = {}
+        self.markers: Dict[tuple, str] = {}
+        self.targets: Dict[tuple, tuple] = {}
+
+    def add_target(self, target: str, py: PythonVersion,
+                   platform: Union[PlatformConfig, str],
+                   blas_flavour: str = ""):
+        """Add the given target and everything it depends on to the build
+        graph. Returns the key of the target's node. Architecture-independent
+        targets get a single node for all hosts (with platform NOARCH), and a
+        node per host that links it into the host's staging directory."""
+        version = str(py) if target in VERSIONED_TARGETS else None
+        if version and py.flavour:
+            version += f"-{py.flavour}"
+        if target not in BLAS_TARGETS:
+            blas_flavour = ""
+        elif blas_flavour:
+            version = blas_flavour
+        key = (target, str(platform), version)
+        if key in self:
+            return key
+        if version is None:
+            py = PythonVersion.current_version()
+        make_target, workers = target, self.workers
+        if target not in NOARCH_TARGETS:
+            deps = TARGET_DEPENDENCIES.get(target, DEFAULT_TARGET_DEPENDENCIES)
+            deps = [self.add_target(d, py, platform, blas_flavour)
+                    for d in deps]
+        elif platform == NOARCH:
+            make_target, deps = f"noarch-{target}", []
+        else:
+            # Creating the links is cheap, and the linked package is already
+            # in the local staging directory, so don't use a remote worker
+            deps, workers = [self.add_target(target, py, NOARCH)], None
+        weight = self.weights.get(target, DEFAULT_TARGET_WEIGHT)
+        weight = max(weight, self.cpus // self.jobs, 1)
+        weight = min(weight, self.cpus)
+        pool = None
+        if workers is not None:
+            # All jobs of a triple run on the same worker, so they also share
+            # the CPUs of that worker
+            worker = workers.worker_for(str(platform))
+            pool = str(worker)
+            self.add_pool(pool, worker.cpus)
+            weight = min(weight, worker.cpus)
+        builder = MakefileBuilder(self.build_triple, [make_target], weight,
+                                  self.recorder, key, self.log_dir,
+                                  self.retries, workers, blas_flavour,
+                                  self.ccache)
+        func = partial(self.run_target, key, builder, py, platform)
+        self.targets[key] = builder, py, platform
+        return self.add(key, func, deps, weight, pool)
+
+    def target_downloads(self, key: tuple) -> List[Download]:
+        """Get the source archives of the given target."""
+        if key[0] in NOARCH_TARGETS and key[1] != NOARCH:
+            return []  # Only links to the package built by another node
+        builder, py, platform = self.targets[key]
+        variables = TARGET_SOURCES.get(key[0], [])
+        variables = [v for var in variables for v in (var, var + "_URL")]
+        if not variables:
+            return []
+        values = builder.query(py, platform, variables)
+        return [Download(this_dir / path, url)
+                for path, url in zip(values[::2], values[1::2])]
+
+    def deferred_downloads(self, key: tuple) -> bool:
+        """Sources of cacheable targets with pinned checksums are only
+        downloaded when the target is not in the cache (see run_target)."""
+        if self.cache is None or key[0] not in CACHEABLE_TARGETS:
+            return False
+        return all(self.pinned_checksum(d.path.name)
+                   for d in self.target_downloads(key))
+
+    def downloads(self, jobs: int) -> List[Download]:
+        """Get the source archives of all targets in the graph that are
+        needed before the build starts."""
+
+        def query(key):
+            if self.deferred_downloads(key):
+                return []
+            return self.target_downloads(key)
+
+        with ThreadPool(max(1, jobs)) as pool:
+            return [d for ds in pool.map(query, self.targets) for d in ds]
+
+    def ancestors(self, key: tuple):
+        result, todo = set(), list(self.nodes[key].deps)
+        while todo:
+            k = todo.pop()
+            if k not in result:
+                result.add(k)
+                todo += self.nodes[k].deps
+        return result
+
+    def pinned_checksum(self, name: str) -> Optional[str]:
+        if self.downloader is None:
+            return None
+        checksum = lookup_checksum(self.downloader.checksums, name)
+        return None if checksum in (UNVERIFIABLE, UNPINNED) else checksum
+
+    def archive_digest(self, path: str, url: str) -> str:
+        """Identify a downloaded archive by its URL and pinned checksum, so a
+        cached package can be restored without downloading its sources. Only
+        archives without a pinned checksum are hashed themselves (an empty
+        string if they weren't downloaded)."""
+        checksum = self.pinned_checksum(Path(path).name)
+        if checksum is not None:
+            return f"{url} {checksum}"
+        return file_digest(this_dir / path)
+
+    def staged_outputs(self, key: tuple) -> List[str]:
+        """Files and directories in the staging directory that the given
+        target produces (relative to this directory)."""
+        builder, py, platform = self.targets[key]
+        target = key[0]
+        if target == "toolchain":
+            toolchain_dir, = builder.query(py, platform, ["TOOLCHAIN_DIR"])
+            return [f"{toolchain_dir}/x-tools"]
+        if target == "cmake":
+            cmake_dir, = builder.query(py, platform, ["CMAKE_DIR"])
+            return [f"{cmake_dir}/{platform}.toolchain-info.cmake"]
+        if target == "pypy":
+            return builder.query(py, platform, ["PYPY_STAGING_DIR"])
+        if target in CACHEABLE_TARGETS:
+            staging_var = CACHEABLE_TARGETS[target][1]
+            return builder.query(py, platform, [staging_var])
+        return []
+
+    def run_target(self, key: tuple, builder: MakefileBuilder,
+                   py: PythonVersion, platform: Union[PlatformConfig, str]):
+        target = key[0]
+        info = CACHEABLE_TARGETS.get(target)
+        if target in NOARCH_TARGETS and platform != NOARCH:
+            # The package was built by the node this one depends on, make
+            # only has to create the links
+            marker, = builder.query(py, platform, [info[2]])
+            return builder((py, platform), [marker])
+        if builder.workers is not None:
+            builder.outputs = self.staged_outputs(key)
+            builder.downloads = self.target_downloads(key)
+        if self.cache is None:
+            return builder((py, platform))
+        # Dependencies may have been restored from the cache without their
+        # sources and build directories, so make shouldn't try to remake them
+        ancestors = self.ancestors(key)
+        assume_old = [self.markers[k] for k in ancestors if k in self.markers]
+        if info is None:
+            return builder((py, platform), assume_old)
+        section, staging_var, marker_var, source_var = info
+        variables = ["STAGING_DIR", "DOWNLOAD_DIR", "TOOLCHAIN",
+                     "TOOLCHAIN_TXZ_URL", "CMAKE_TOOLCHAIN", staging_var,
+                     marker_var]
+        if source_var:
+            variables += [source_var, source_var + "_URL"]
+        extra_vars = TARGET_EXTRA_VARIABLES.get(target, [])
+        values = builder.query(py, platform, variables + extra_vars)
+        extra_files = values[len(variables):]
+        staging_dir, download_dir, toolchain, toolchain_url = values[:4]
+        cmake_toolchain, staging, marker = values[4:7]
+        source, source_url = values[7:9] if source_var else ("", "")
+
+        archives = [self.archive_digest(download_dir + "/" + toolchain,
+                                        toolchain_url)]
+        if source:
+            archives.append(self.archive_digest(source, source_url))
+        # Links to noarch packages have no key of their own, the package itself
+        # has one (and is an ancestor as well)
+        uncached = [k for k in ancestors if k[0] in CACHEABLE_TARGETS and
+                    k not in self.cache_keys and
+                    not (k[0] in NOARCH_TARGETS and k[1] != NOARCH)]
+        if not all(archives) or uncached:
+            # An archive that is neither pinned nor available locally can't be
+            # identified, so neither can the result
+            print(f"Not caching {target} for {platform}: its sources, "
+                  "toolchain or dependencies can't be identified")
+            return builder((py, platform), assume_old)
+
+        props = ""
+        if platform != NOARCH:
+            props = repr(dataclasses.asdict(platform_info(platform)))
+        inputs = [target, str(platform), staging, self.sections[section],
+                  props] + archives
+        if any(k[0] == "cmake" for k in ancestors):
+            inputs.append(file_digest(this_dir / cmake_toolchain))
+        inputs += [file_digest(this_dir / f)
+                   for f in TARGET_EXTRA_INPUTS.get(target, [])]
+        inputs += [file_digest(this_dir / f) if f else ""
+                   for f in extra_files]
+        inputs += sorted(self.cache_keys[k] for k in ancestors
+                         if k in self.cache_keys)
+        cache_key = inputs_digest(inputs)
+
+        base_dir = this_dir / staging_dir
+        name = Path(staging).name
+        if self.cache.lookup(cache_key):
+            links = [name] + staging_links(base_dir, name)
+            if self.cache.restore(cache_key, base_dir, links):
+                print(f"Restored {target} for {platform} from the cache "
+                      f"({cache_key[:16]})")
+                # Make sure that make considers the restored files up to date
+                os.utime(this_dir / marker)
+                self.cache_keys[key] = cache_key
+                self.markers[key] = marker
+                return
+        if self.deferred_downloads(key):
+            for download in self.target_downloads(key):
+                self.downloader(download)
+        builder((py, platform), assume_old)
+        self.cache.store(cache_key, base_dir,
+                         [name] + staging_links(base_dir, name))
+        self.cache_keys[key] = cache_key
+        self.markers[key] = marker
+
+
+def predict_durations(graph: BuildGraph, db: DurationDB):
+    """The predicted duration of every job in the graph, and the jobs that
+    have no previous duration of their own."""
+    durations: Dict[tuple, float] = {}
+    unknown = []
+    for key, (builder, _, _) in graph.targets.items():
+        if builder.name not in db.durations:
+            unknown.append(key)
+        estimate = db.estimate(builder.name)
+        durations[key] = DEFAULT_JOB_DURATION if estimate is None else estimate
+    return durations, unknown
+
+
+def print_plan(graph: BuildGraph, durations: Dict[tuple, float],
+               unknown: List[tuple], priorities: Dict[tuple, float],
+               jobs: int, cpus: int):
+    """Print the predicted start and end time of every job, and the total
+    duration of the build."""
+    times = graph.simulate(durations, jobs, cpus, priorities)
+    print(f"{'Start':>8} {'End':>8}  Job")
+    for key, (start, end) in sorted(times.items(), key=lambda i: i[1]):
+        mark = " (estimated)" if key in unknown else ""
+        print(f"{start:7.0f}s {end:7.0f}s  {graph.targets[key][0].name}{mark}")
+    makespan = max((end for _, end in times.values()), default=0.0)
+    print(f"\nPredicted duration with {jobs} jobs and {cpus} CPUs: "
+          f"{makespan:.0f}s ({len(unknown)} of {len(times)} jobs estimated, "
+          "not taking the cache into account)")
+
+
+def print_results(graph: BuildGraph, results: Dict[tuple, Optional[Exception]],
+                  tail: int = 20) -> bool:
+    """Print the failed and skipped jobs, with the end of the logs of the
+    failed ones. Returns True if all jobs succeeded."""
+    failed = [k for k, e in results.items()
+              if e is not None and not isinstance(e, Skipped)]
+    skipped = [k for k, e in results.items() if isinstance(e, Skipped)]
+    for key in failed:
+        builder = graph.targets[key][0]
+        print(f"\n{builder.name} failed: {results[key]}")
+        log = builder.log_file
+        if log is not None and log.exists():
+            lines = log.read_text(errors="replace").splitlines()
+            print("\n".join(lines[-tail:]))
+            print(f"Full log: {log}")
+    for key in skipped:
+        print(f"{graph.targets[key][0].name} skipped: {results[key]}")
+    succeeded = len(results) - len(failed) - len(skipped)
+    print(f"\n{succeeded} succeeded, {len(failed)} failed, "
+          f"{len(skipped)} skipped")
+    return not failed and not skipped
+
+
+def parse_weight(s: str):
+    target, _, weight = s.rpartition("=")
+    if not target:
+        raise argparse.ArgumentTypeError(f"expected TARGET=N, got '{s}'")
+    return target, int(weight)
 
 
 def main():
@@ -133,7 +733,8 @@ def main():
         "--host",
         type=str,
         action='append',
-        help="GNU triples for the host machines",
+        help="GNU triples for the host machines (see PLATFORMS in "
+        "platform_config.py)",
     )
     parser.add_argument(
         "--jobs",
@@ -142,6 +743,105 @@ def main():
         default=1,
         help="Number of parallel jobs",
     )
+    parser.add_argument(
+        "--cpus",
+        type=int,
+        help="Total number of CPUs shared by all parallel jobs (default: "
+        "the number of CPUs of this machine, or of all workers)",
+    )
+    parser.add_argument(
+        "--weight",
+        type=parse_weight,
+        action='append',
+        default=[],
+        metavar="TARGET=N",
+        help="Number of CPUs to assign to the builds of the given target",
+    )
+    parser.add_argument(
+        "--cache",
+        type=Path,
+        default=os.environ.get("CROSS_PYTHON_CACHE"),
+        help="Directory with cached build artifacts (may be shared)",
+    )
+    parser.add_argument(
+        "--ccache-dir",
+        type=Path,
+        default=os.environ.get(CCACHE_DIR_ENV),
+        help="Directory for the ccache caches of all triples (one "
+        "subdirectory per triple, default: ccache's own configuration)",
+    )
+    parser.add_argument(
+        "--ccache-size",
+        type=str,
+        default="5G",
+        help="Maximum size of the ccache cache of each triple (with "
+        "--ccache-dir)",
+    )
+    parser.add_argument(
+        "--worker",
+        type=str,
+        action='append',
+        metavar="HOST:PORT",
+        help="Run the jobs on the given remote worker (see build.py worker "
+        "--help) instead of locally",
+    )
+    parser.add_argument(
+        "--keep-going",
+        "-k",
+        action='store_true',
+        help="Keep building the targets that don't depend on a failed job",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=2,
+        help="Number of times to retry jobs that fail while downloading or "
+        "extracting sources",
+    )
+    parser.add_argument(
+        "--log-dir",
+        type=Path,
+        default=this_dir / "build" / "logs",
+        help="Directory to write the output of each job to",
+    )
+    parser.add_argument(
+        "--trace",
+        type=Path,
+        default=this_dir / "build" / "trace.json",
+        help="Write the timings of all jobs to this file, in the Chrome trace "
+        "format",
+    )
+    parser.add_argument(
+        "--durations",
+        type=Path,
+        default=this_dir / "build" / "durations.json",
+        help="File with the durations of previous jobs, used to start the "
+        "jobs on the longest chains of dependent jobs first",
+    )
+    parser.add_argument(
+        "--plan",
+        action='store_true',
+        help="Only print the order in which the jobs would run and the "
+        "predicted duration of the build, given --jobs and --cpus",
+    )
+    parser.add_argument(
+        "--download-jobs",
+        type=int,
+        default=8,
+        help="Number of parallel downloads",
+    )
+    parser.add_argument(
+        "--mirror",
+        type=Path,
+        help="Copy source archives from this directory instead of "
+        "downloading them",
+    )
+    parser.add_argument(
+        "--update-checksums",
+        action='store_true',
+        help="Record the checksums of downloaded files without a known "
+        "or pinned checksum in " + CHECKSUMS_FILE,
+    )
     parser.add_argument(
         "--python",
         "--py",
@@ -150,6 +850,25 @@ def main():
         action='append',
         help="Python versions to build",
     )
+    parser.add_argument(
+        "--python-flavour",
+        type=str,
+        choices=list(PYTHON_FLAVOURS),
+        action='append',
+        help="Variants of CPython to build (default: default). The optimized "
+        "one uses PGO if a profile was gathered using make "
+        "python-pgo-profile, the free-threaded one (3.13 and later) is "
+        "staged as e.g. python3.13t",
+    )
+    parser.add_argument(
+        "--blas-flavour",
+        type=str,
+        choices=list(BLAS_FLAVOURS),
+        action='append',
+        help="Variants of OpenBLAS (and of MUMPS, Ipopt and SuiteSparse) to "
+        "build (default: default). The dynamic one (only for x86-64 and "
+        "AArch64) selects the kernels for the CPU at run time",
+    )
     parser.add_argument(
         "--pypy",
         type=str,
@@ -173,6 +892,10 @@ def main():
     platforms = DEF_PLATFORMS
     if args.host:
         platforms = list(map(PlatformConfig.from_string, args.host))
+        for p in platforms:
+            if str(p) not in known_platforms():
+                print(f"Warning: unknown platform {p}, using the defaults "
+                      f"for {p.cpu}", file=sys.stderr)
 
     python_versions = None
     if args.python == [None]:
@@ -193,24 +916,114 @@ def main():
         packages = args.package
 
     jobs = args.jobs if args.jobs > 0 else max(1, os.cpu_count() // 2)
+    workers = WorkerPool(args.worker) if args.worker else None
+    cpus = args.cpus or (workers.cpus if workers else os.cpu_count())
+    cpus = max(1, cpus)
+    weights = dict(TARGET_WEIGHTS, **dict(args.weight))
+
+    cache = ArtifactCache(args.cache) if args.cache else None
+    if cache is not None and workers is not None:
+        # Restored packages would only end up in the local staging directory,
+        # not on the worker that builds the packages that depend on them
+        print("Warning: --cache is not supported with remote workers, not "
+              "using the cache", file=sys.stderr)
+        cache = None
+    ccache = None
+    if args.ccache_dir:
+        ccache = CcacheConfig(args.ccache_dir, args.ccache_size)
+
+    recorder = Recorder(this_dir / "build" / "trace")
+    checksums_path = this_dir / CHECKSUMS_FILE
+    urls: Dict[str, str] = {}
+    checksums = read_checksums(checksums_path, urls)
+    # Checksums of unpinned archives, recorded by earlier builds
+    local_checksums_path = this_dir / "build" / CHECKSUMS_FILE
+    local_checksums = read_checksums(local_checksums_path)
+    for name, digest in local_checksums.items():
+        if checksums.get(name) == UNPINNED:
+            checksums[name] = digest
+    downloader = Downloader(checksums, args.mirror,
+                            record=args.update_checksums, urls=urls)
+    graph = BuildGraph(args.build, jobs, cpus, weights, cache, recorder,
+                       args.log_dir, args.retries, workers, ccache, downloader)
+    if python_versions:
+        flavours = [PYTHON_FLAVOURS[f]
+                    for f in args.python_flavour or ["default"]]
+        for py, flavour, plat in product(python_versions, flavours,
+                                         platforms):
+            if flavour == "freethreaded" and \
+                    (int(py.major), int(py.minor)) < FREE_THREADED_MIN_VERSION:
+                print(f"Skipping free-threaded Python {py} for {plat}: not "
+                      "supported", file=sys.stderr)
+                continue
+            py = dataclasses.replace(py, flavour=flavour)
+            graph.add_target("python", py, plat)
+    if pypy_versions:
+        pypy_platforms = list(filter(is_pypy_platform, platforms))
+        for py, plat in product(pypy_versions, pypy_platforms):
+            graph.add_target("pypy", py, plat)
+    if packages:
+        current = PythonVersion.current_version()
+        blas_flavours = [BLAS_FLAVOURS[f]
+                         for f in args.blas_flavour or ["default"]]
+        for pkg, plat in product(packages, platforms):
+            for flavour in blas_flavours if pkg in BLAS_TARGETS else [""]:
+                if flavour == "dynamic" and not is_dynamic_blas_platform(plat):
+                    print(f"Skipping {pkg}-{flavour} for {plat}: not "
+                          "supported", file=sys.stderr)
+                    continue
+                graph.add_target(pkg, current, plat, flavour)
+
+    durations = DurationDB(args.durations)
+    predicted, unknown = predict_durations(graph, durations)
+    priorities = graph.priorities(predicted)
+    if args.plan:
+        print_plan(graph, predicted, unknown, priorities, jobs, cpus)
+        return
+
+    # Generate the toolchain files etc. for all triples up front, in-process
+    triples = sorted({str(p) for p in platforms})
+    gen_configs.generate(triples, this_dir / "staging", this_dir / "build")
+
+    # Remote workers download and verify the sources they need themselves
+    downloads = graph.downloads(args.download_jobs) if workers is None else []
+    failed_downloads = downloader.run(downloads, args.download_jobs)
+    if args.update_checksums:
+        write_checksums(checksums_path, checksums, downloader.recorded)
+    elif downloader.recorded:
+        # Verify unpinned archives against the checksums of their first
+        # download in later builds, without changing the tracked manifest
+        local_checksums.update((n, checksums[n]) for n in downloader.recorded)
+        local_checksums_path.parent.mkdir(parents=True, exist_ok=True)
+        write_checksums(local_checksums_path, local_checksums,
+                        downloader.recorded)
+    if failed_downloads and not args.keep_going:
+        sys.exit(f"{len(failed_downloads)} download(s) failed")
 
-    with Pool(jobs) as p:
-        if python_versions:
-            p.map(
-                MakefileBuilder(args.build, ["python"]),
-                product(python_versions, platforms),
-            )
-        if pypy_versions:
-            p.map(
-                MakefileBuilder(args.build, ["pypy"]),
-                product(pypy_versions, filter(is_pypy_platform, platforms)),
-            )
-        if packages:
-            p.map(
-                MakefileBuilder(args.build, packages),
-                product([PythonVersion.current_version()], platforms),
-            )
+    try:
+        results = graph.run(jobs, cpus, args.keep_going, priorities)
+    finally:
+        recorder.write_trace(args.trace)
+        durations.update(recorder.records.values())
+        durations.save()
+        deps = {k: n.deps for k, n in graph.nodes.items()}
+        print(recorder.summary(deps))
+    if not print_results(graph, results):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:2] == ["bench"]:
+        import bench
+        bench.main(sys.argv[2:])
+    elif sys.argv[1:2] == ["worker"]:
+        import remote
+        remote.main(sys.argv[2:])
+    elif sys.argv[1:2] == ["package"]:
+        import package
+        package.main(sys.argv[2:])
+    elif sys.argv[1:2] == ["fetch"]:
+        import fetch
+        fetch.main(sys.argv[2:])
+    else:
+        main()
@@ -0,0 +1,36 @@
+import dataclasses
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+# Environment variable with the default for build.py --ccache-dir
+CCACHE_DIR_ENV = "CROSS_PYTHON_CCACHE"
+
+
+@dataclasses.dataclass
+class CcacheConfig:
+    """ccache settings for the jobs of a build. Every triple gets its own
+    cache in a subdirectory of ``dir`` (nothing can be shared between
+    different compilers anyway), each limited to ``max_size`` (e.g. 5G)."""
+    dir: Path
+    max_size: str = ""
+
+    def env(self, triple: str) -> Dict[str, str]:
+        env = {"CCACHE_DIR": str(self.dir.resolve() / triple)}
+        if self.max_size:
+            env["CCACHE_MAXSIZE"] = self.max_size
+        return env
+
+
+def read_stats_log(path: Path) -> Optional[Tuple[int, int]]:
+    """Count the cache hits and misses in a ccache statistics log (see
+    CCACHE_STATSLOG, ccache 4.4 or later), which has the outcome of every
+    compilation. Returns None if ccache didn't write the log."""
+    if not path.exists():
+        return None
+    hits = misses = 0
+    for line in path.read_text(errors="replace").splitlines():
+        if line.endswith("_cache_hit"):  # direct or preprocessed
+            hits += 1
+        elif line == "cache_miss":
+            misses += 1
+    return hits, misses
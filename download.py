@@ -0,0 +1,214 @@
+import dataclasses
+from fnmatch import fnmatchcase
+import hashlib
+from multiprocessing.pool import ThreadPool
+import os
+from pathlib import Path
+import shutil
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+import urllib.error
+import urllib.request
+
+
+# SHA-256 checksums of the source archives, in the format of sha256sum
+CHECKSUMS_FILE = "checksums.sha256"
+
+
+@dataclasses.dataclass(frozen=True)
+class Download:
+    path: Path  # Destination of the file
+    url: str
+
+
+# Checksum of archives that are downloaded from a moving reference (a branch or
+# the latest release), which cannot be verified. In the checksums file, these
+# are listed with "unverifiable" instead of a hash, and the name may be a
+# pattern with wildcards.
+UNVERIFIABLE = "unverifiable"
+# Checksum of archives of a fixed version whose hash hasn't been pinned yet.
+# Their hash is recorded when they are first downloaded, and verified after
+# that.
+UNPINNED = "unpinned"
+
+
+def read_checksums(path: Path,
+                   urls: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """Read a file in the format of sha256sum, mapping file names to their
+    SHA-256 hashes (or UNVERIFIABLE or UNPINNED). Each line may end with the
+    URL the file is downloaded from, which is stored in urls if given."""
+    checksums = {}
+    if not path.exists():
+        return checksums
+    for line in path.read_text().splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        digest, name, *url = line.split()
+        name = name.lstrip("*")
+        checksums[name] = digest.lower()
+        if url and urls is not None:
+            urls[name] = url[0]
+    return checksums
+
+
+def write_checksums(path: Path, checksums: Dict[str, str],
+                    urls: Optional[Dict[str, str]] = None):
+    header = [
+        l for l in path.read_text().splitlines() if l.startswith("#")
+    ] if path.exists() else []
+    # Keep the URLs that are already listed
+    all_urls: Dict[str, str] = {}
+    read_checksums(path, all_urls)
+    all_urls.update(urls or {})
+    items = sorted(checksums.items(), key=lambda i: (i[1] != UNVERIFIABLE, i))
+    lines = header + [f"{d}  {n}  {all_urls[n]}" if n in all_urls
+                      else f"{d}  {n}" for n, d in items]
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text("\n".join(lines) + "\n")
+    os.replace(tmp, path)
+
+
+def lookup_checksum(checksums: Dict[str, str], name: str) -> Optional[str]:
+    """Return the checksum of the given file (or UNPINNED), UNVERIFIABLE if it
+    matches one of the unverifiable patterns, or None if it is not listed."""
+    if name in checksums:
+        return checksums[name]
+    for pattern, digest in checksums.items():
+        if digest == UNVERIFIABLE and fnmatchcase(name, pattern):
+            return digest
+    return None
+
+
+def sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ChecksumError(RuntimeError):
+    pass
+
+
+class Downloader:
+    """Downloads files with bounded concurrency. Interrupted downloads are
+    resumed using HTTP range requests, and files are only moved to their final
+    location after their checksum has been verified, so a partial download is
+    never mistaken for a complete one. If a mirror directory is given, files
+    are copied from there instead of downloading them. The checksums of
+    unpinned files (and with record, of all unlisted files) are added to
+    checksums and listed in recorded."""
+
+    def __init__(self, checksums: Dict[str, str], mirror: Optional[Path] = None,
+                 attempts: int = 3, record: bool = False,
+                 urls: Optional[Dict[str, str]] = None):
+        self.checksums = checksums
+        self.mirror = mirror
+        self.attempts = attempts
+        self.record = record
+        self.urls = urls if urls is not None else {}
+        self.recorded: Dict[str, str] = {}  # File names and their URLs
+        self.lock = threading.Lock()
+        # Only one thread at a time may download to the same path
+        self.path_locks: Dict[Path, threading.Lock] = {}
+
+    def _path_lock(self, path: Path) -> threading.Lock:
+        with self.lock:
+            return self.path_locks.setdefault(path.resolve(),
+                                              threading.Lock())
+
+    def _fetch_url(self, url: str, part: Path):
+        offset = part.stat().st_size if part.exists() else 0
+        req = urllib.request.Request(url)
+        if offset:
+            req.add_header("Range", f"bytes={offset}-")
+        try:
+            resp = urllib.request.urlopen(req, timeout=60)
+        except urllib.error.HTTPError as e:
+            if e.code == 416:  # The partial file is already complete
+                return
+            raise
+        with resp:
+            # The server may ignore the range request and send everything
+            mode = "ab" if offset and resp.getcode() == 206 else "wb"
+            with open(part, mode) as f:
+                shutil.copyfileobj(resp, f, 1 << 20)
+
+    def _fetch(self, dl: Download, part: Path):
+        if self.mirror is not None:
+            print(f"Copying {dl.path.name} from {self.mirror}")
+            shutil.copyfile(self.mirror / dl.path.name, part)
+            return
+        for attempt in range(self.attempts):
+            try:
+                print(f"Downloading {dl.url}")
+                return self._fetch_url(dl.url, part)
+            except (urllib.error.URLError, OSError) as e:
+                if attempt + 1 == self.attempts:
+                    raise
+                print(f"Download of {dl.url} failed ({e}), retrying")
+                time.sleep(2**attempt)
+
+    def _verify(self, dl: Download, path: Path):
+        name = dl.path.name
+        expected = lookup_checksum(self.checksums, name)
+        if expected == UNVERIFIABLE:
+            return True
+        actual = sha256(path)
+        if expected is None or expected == UNPINNED:
+            with self.lock:
+                self.checksums[name] = actual
+                self.recorded[name] = dl.url
+            return True
+        return actual == expected
+
+    def __call__(self, dl: Download):
+        name = dl.path.name
+        if lookup_checksum(self.checksums, name) is None and not self.record:
+            # Only archives of moving references may be used unverified
+            raise ChecksumError(f"No checksum for {name} (record it using "
+                                "build.py --update-checksums)")
+        url = self.urls.get(name)
+        if url is not None and url != dl.url:
+            # The checksum belongs to a different file
+            raise ChecksumError(f"{name} is listed with URL {url}, but is "
+                                f"downloaded from {dl.url}")
+        # Several jobs may need the same archive at the same time (e.g. the
+        # sources of a package for different triples)
+        with self._path_lock(dl.path):
+            self._download(dl)
+
+    def _download(self, dl: Download):
+        name = dl.path.name
+        if dl.path.exists():
+            if self._verify(dl, dl.path):
+                return
+            print(f"Checksum mismatch for existing {dl.path}, downloading again")
+            dl.path.unlink()
+        dl.path.parent.mkdir(parents=True, exist_ok=True)
+        part = dl.path.with_name(name + ".part")
+        self._fetch(dl, part)
+        if not self._verify(dl, part):
+            part.unlink()
+            raise ChecksumError(f"Checksum mismatch for {name} ({dl.url})")
+        os.replace(part, dl.path)
+
+    def _try(self, dl: Download) -> Optional[Exception]:
+        try:
+            self(dl)
+        except Exception as e:
+            print(f"Failed to download {dl.url}: {e}")
+            return e
+        return None
+
+    def run(self, downloads: Iterable[Download], jobs: int) -> List[Download]:
+        """Download all files. A failed download doesn't stop the others.
+        Returns the downloads that failed."""
+        # Multiple triples and targets share the same download directory
+        unique: List[Download] = list({d.path: d for d in downloads}.values())
+        with ThreadPool(max(1, jobs)) as pool:
+            errors = pool.map(self._try, unique, chunksize=1)
+        return [d for d, e in zip(unique, errors) if e is not None]
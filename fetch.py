@@ -0,0 +1,218 @@
+import argparse
+import json
+import os
+from pathlib import Path
+import shutil
+from subprocess import run
+import sys
+import tempfile
+from typing import Dict, List, Optional
+import urllib.request
+
+from download import Download, Downloader
+from package import index_name
+
+this_dir = Path(__file__).parent
+
+DEFAULT_SOURCE = \
+    "https://github.com/tttapa/cross-python/releases/latest/download"
+
+
+def default_cache_dir() -> Path:
+    cache = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache) / "cross-python" / "archives"
+
+
+def is_url(source: str) -> bool:
+    return "://" in source
+
+
+def load_index(source: str, triple: str) -> dict:
+    """Read the index of the components of the given triple (written by
+    build.py package --split) from a URL or a local directory."""
+    name = index_name(triple)
+    if not is_url(source):
+        return json.loads((Path(source) / name).read_text())
+    url = f"{source.rstrip('/')}/{name}"
+    with urllib.request.urlopen(url, timeout=60) as resp:
+        return json.loads(resp.read())
+
+
+def resolve(index: dict, requested: List[str]) -> List[str]:
+    """The requested components and everything they depend on, with the
+    dependencies before the components that need them."""
+    components = index["components"]
+    result: List[str] = []
+    visiting = set()
+
+    def visit(name):
+        if name in result:
+            return
+        if name not in components:
+            raise KeyError(f"Unknown component {name!r} for "
+                           f"{index['triple']} (available: "
+                           + ", ".join(sorted(components)) + ")")
+        if name in visiting:
+            raise ValueError(f"Circular dependency on {name!r}")
+        visiting.add(name)
+        for dep in components[name]["depends"]:
+            visit(dep)
+        result.append(name)
+
+    for name in requested:
+        visit(name)
+    return result
+
+
+class Fetcher:
+    """Downloads the archives of components into a local cache, and extracts
+    them into a staging directory. Archives are verified against the hashes
+    in the index, and components that are already installed with the same
+    hash are not extracted again."""
+
+    def __init__(self, source: str, staging_dir: Path, cache_dir: Path,
+                 jobs: int = 4):
+        self.source = source
+        self.staging_dir = staging_dir
+        self.cache_dir = cache_dir
+        self.jobs = jobs
+
+    def state_file(self, triple: str) -> Path:
+        return self.staging_dir / f".fetched-{triple}.json"
+
+    def installed(self, triple: str) -> Dict[str, str]:
+        path = self.state_file(triple)
+        return json.loads(path.read_text()) if path.exists() else {}
+
+    def download(self, index: dict, names: List[str]) -> bool:
+        components = index["components"]
+        checksums = {components[n]["archive"]: components[n]["sha256"]
+                     for n in names}
+        mirror = None if is_url(self.source) else Path(self.source)
+        downloader = Downloader(checksums, mirror)
+        downloads = [Download(self.cache_dir / a,
+                              f"{self.source.rstrip('/')}/{a}")
+                     for a in checksums]
+        return not downloader.run(downloads, self.jobs)
+
+    def extract(self, triple: str, component: dict):
+        root = self.staging_dir / triple
+        root.mkdir(parents=True, exist_ok=True)
+        for m in component["members"]:
+            p = root / m
+            if p.is_symlink() or p.is_file():
+                p.unlink()
+            elif p.exists():
+                shutil.rmtree(p)
+        archive = self.cache_dir / component["archive"]
+        run(["tar", "-x", "-I", "zstd -d", "-f", str(archive), "-C",
+             str(self.staging_dir)], check=True)
+
+    def __call__(self, triple: str, requested: List[str]) -> bool:
+        index = load_index(self.source, triple)
+        names = resolve(index, requested)
+        installed = self.installed(triple)
+        root = self.staging_dir / triple
+        todo = []
+        for n in names:
+            c = index["components"][n]
+            # Links to architecture-independent packages must not dangle
+            present = all(os.path.exists(root / m) for m in c["members"])
+            if installed.get(n) != c["sha256"] or not present:
+                todo.append(n)
+        if not todo:
+            print(f"{triple}: " + ", ".join(names) + " already up to date")
+            return True
+        size = sum(index["components"][n]["size"] for n in todo)
+        print(f"{triple}: fetching " + ", ".join(todo) +
+              f" ({size / 2**20:.1f} MiB)")
+        if not self.download(index, todo):
+            return False
+        for n in todo:
+            self.extract(triple, index["components"][n])
+            installed[n] = index["components"][n]["sha256"]
+            state = self.state_file(triple)
+            fd, tmp = tempfile.mkstemp(dir=self.staging_dir, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(installed, f, indent=2)
+            os.replace(tmp, state)
+        return True
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="build.py fetch",
+        description="Download only the given components (and the components "
+        "they depend on) of the pre-built staging directories",
+        allow_abbrev=False,
+    )
+    parser.add_argument(
+        "components",
+        type=str,
+        nargs='*',
+        help="Components to fetch, e.g. python3.11 pybind11 x-tools",
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        action='append',
+        required=True,
+        help="GNU triples to fetch the components for",
+    )
+    parser.add_argument(
+        "--from",
+        dest="source",
+        type=str,
+        default=DEFAULT_SOURCE,
+        help="URL or local directory with the archives and indices "
+        "(default: the latest release)",
+    )
+    parser.add_argument(
+        "--staging-dir",
+        type=Path,
+        default=this_dir / "staging",
+        help="Directory to extract the components into",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=default_cache_dir(),
+        help="Directory to keep the downloaded archives in",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=4,
+        help="Number of parallel downloads",
+    )
+    parser.add_argument(
+        "--list",
+        action='store_true',
+        help="List the available components and their dependencies",
+    )
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for triple in args.host:
+            index = load_index(args.source, triple)
+            print(f"{triple}:")
+            for name, c in sorted(index["components"].items()):
+                deps = ", ".join(c["depends"])
+                print(f"  {name:24} {c['size'] / 2**20:8.1f} MiB"
+                      + (f"  (needs {deps})" if deps else ""))
+        return
+    if not args.components:
+        parser.error("no components given")
+    fetcher = Fetcher(args.source, args.staging_dir, args.cache_dir,
+                      args.jobs)
+    failed = []
+    for triple in args.host:
+        try:
+            ok = fetcher(triple, args.components)
+        except KeyError as e:
+            sys.exit(e.args[0])
+        if not ok:
+            failed.append(triple)
+    if failed:
+        sys.exit("Fetching failed for " + ", ".join(failed))
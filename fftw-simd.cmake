@@ -0,0 +1,45 @@
+# Included by FFTW's CMakeLists.txt (CMAKE_PROJECT_INCLUDE) to add the options
+# ENABLE_NEON and ENABLE_AVX512, which only its configure script has. The
+# codelets of the enabled extensions are added to the library once it has been
+# defined, and HAVE_NEON/HAVE_AVX512 are defined for all sources (which affects
+# e.g. the alignment of the data structures in kernel/ifftw.h).
+
+set(_fftw_simd_sources)
+
+if (ENABLE_NEON AND NOT ENABLE_LONG_DOUBLE AND NOT ENABLE_QUAD_PRECISION)
+    # NEON only supports double precision on AArch64
+    if (ENABLE_FLOAT OR CMAKE_SYSTEM_PROCESSOR STREQUAL "aarch64")
+        set(HAVE_NEON TRUE)
+        add_compile_definitions(HAVE_NEON=1)
+        file(GLOB _fftw_neon_sources
+            "${PROJECT_SOURCE_DIR}/dft/simd/neon/*.c"
+            "${PROJECT_SOURCE_DIR}/rdft/simd/neon/*.c")
+        if (NOT CMAKE_SYSTEM_PROCESSOR STREQUAL "aarch64"
+                AND NOT CMAKE_C_FLAGS MATCHES "-mfpu=")
+            set_source_files_properties(${_fftw_neon_sources}
+                PROPERTIES COMPILE_OPTIONS "-mfpu=neon")
+        endif()
+        list(APPEND _fftw_simd_sources ${_fftw_neon_sources}
+            "${PROJECT_SOURCE_DIR}/simd-support/neon.c")
+    endif()
+endif()
+
+if (ENABLE_AVX512 AND NOT ENABLE_LONG_DOUBLE AND NOT ENABLE_QUAD_PRECISION)
+    set(HAVE_AVX512 TRUE)
+    add_compile_definitions(HAVE_AVX512=1)
+    file(GLOB _fftw_avx512_sources
+        "${PROJECT_SOURCE_DIR}/dft/simd/avx512/*.c"
+        "${PROJECT_SOURCE_DIR}/rdft/simd/avx512/*.c")
+    set_source_files_properties(${_fftw_avx512_sources}
+        PROPERTIES COMPILE_OPTIONS "-mavx512f")
+    list(APPEND _fftw_simd_sources ${_fftw_avx512_sources}
+        "${PROJECT_SOURCE_DIR}/simd-support/avx512.c")
+endif()
+
+function(fftw_add_simd_sources)
+    target_sources(${fftw3_lib} PRIVATE ${_fftw_simd_sources})
+endfunction()
+
+if (_fftw_simd_sources)
+    cmake_language(DEFER CALL fftw_add_simd_sources)
+endif()
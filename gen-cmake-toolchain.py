@@ -1,3 +1,6 @@
+import os
+import re
+from subprocess import PIPE, run
 import sys
 from platform_config import (
     PlatformConfig,
@@ -6,6 +9,7 @@ from platform_config import (
     cmake_system_processor,
     cpack_debian_architecture,
     multiarch_lib_dir,
+    toolchain_triple,
 )
 
 toolchain_contents = """\
@@ -37,8 +41,11 @@ set(CMAKE_FIND_ROOT_PATH_MODE_PACKAGE ONLY)
 # Packaging
 set(CPACK_DEBIAN_PACKAGE_ARCHITECTURE "{CPACK_DEBIAN_PACKAGE_ARCHITECTURE}")
 
-# Toolchain and sysroot
-set(TOOLCHAIN_DIR "${{CMAKE_CURRENT_LIST_DIR}}/x-tools/${{CROSS_GNU_TRIPLE}}")
+# Toolchain and sysroot (by default the toolchain next to this file, which may
+# be a link to the shared toolchain store, but it can be used directly as well)
+set(TOOLCHAIN_DIR "${{CMAKE_CURRENT_LIST_DIR}}/x-tools/${{CROSS_GNU_TRIPLE}}"
+    CACHE PATH "Path to the GCC toolchain")
+list(APPEND CMAKE_TRY_COMPILE_PLATFORM_VARIABLES TOOLCHAIN_DIR)
 set(CMAKE_SYSROOT "${{TOOLCHAIN_DIR}}/${{CROSS_GNU_TRIPLE}}/sysroot")
 
 # Clang toolchain
@@ -79,28 +86,38 @@ if (TOOLCHAIN_USE_CLANG)
         set(CMAKE_Fortran_COMPILER_FORCED On)
     endif()
 
-    # Get the machine triple from GCC
-    execute_process(COMMAND ${{TOOLCHAIN_C_COMPILER}} -dumpmachine
-                    OUTPUT_VARIABLE CROSS_GNU_TRIPLE_EFFECTIVE
-                    ERROR_VARIABLE CROSS_GNU_TRIPLE_EFFECTIVE_ERROR
-                    OUTPUT_STRIP_TRAILING_WHITESPACE)
-    set(CROSS_GNU_TRIPLE_EFFECTIVE ${{CROSS_GNU_TRIPLE_EFFECTIVE}}
-        CACHE STRING "The GNU triple of the toolchain actually in use")
-    if (NOT CROSS_GNU_TRIPLE_EFFECTIVE)
-        message(FATAL_ERROR "Unable to determine GCC triple ${{CROSS_GNU_TRIPLE_EFFECTIVE}} ${{CROSS_GNU_TRIPLE_EFFECTIVE_ERROR}}")
-    endif()
+    # The machine triple and installation folder of GCC are precomputed when
+    # the toolchain file is generated (if the toolchain was available), and
+    # cached after the first configure, so GCC only needs to be queried when
+    # neither is the case
+    include("${{CMAKE_CURRENT_LIST_DIR}}/{TRIPLE}.toolchain-info.cmake"
+        OPTIONAL)
+    if (NOT CROSS_GNU_TRIPLE_EFFECTIVE OR NOT EXISTS "${{TOOLCHAIN_GCC_INSTALL_LIB}}")
+        # Get the machine triple from GCC
+        execute_process(COMMAND ${{TOOLCHAIN_C_COMPILER}} -dumpmachine
+                        OUTPUT_VARIABLE CROSS_GNU_TRIPLE_EFFECTIVE
+                        ERROR_VARIABLE CROSS_GNU_TRIPLE_EFFECTIVE_ERROR
+                        OUTPUT_STRIP_TRAILING_WHITESPACE)
+        if (NOT CROSS_GNU_TRIPLE_EFFECTIVE)
+            message(FATAL_ERROR "Unable to determine GCC triple ${{CROSS_GNU_TRIPLE_EFFECTIVE}} ${{CROSS_GNU_TRIPLE_EFFECTIVE_ERROR}}")
+        endif()
 
-    # Get the installation folder from GCC
-    execute_process(COMMAND ${{TOOLCHAIN_C_COMPILER}} -print-search-dirs
-                    OUTPUT_VARIABLE TOOLCHAIN_GCC_INSTALL
-                    ERROR_VARIABLE TOOLCHAIN_GCC_INSTALL_ERROR)
-    string(REGEX MATCH "(^|\\r|\\n)install: +([^\\r\\n]*)" 
-        TOOLCHAIN_GCC_INSTALL_LINE ${{TOOLCHAIN_GCC_INSTALL}})
-    if (NOT TOOLCHAIN_GCC_INSTALL_LINE)
-        message(FATAL_ERROR "Unable to determine GCC installation ${{TOOLCHAIN_GCC_INSTALL}} ${{TOOLCHAIN_GCC_INSTALL_ERROR}}")
+        # Get the installation folder from GCC
+        execute_process(COMMAND ${{TOOLCHAIN_C_COMPILER}} -print-search-dirs
+                        OUTPUT_VARIABLE TOOLCHAIN_GCC_INSTALL
+                        ERROR_VARIABLE TOOLCHAIN_GCC_INSTALL_ERROR)
+        string(REGEX MATCH "(^|\\r|\\n)install: +([^\\r\\n]*)" 
+            TOOLCHAIN_GCC_INSTALL_LINE ${{TOOLCHAIN_GCC_INSTALL}})
+        if (NOT TOOLCHAIN_GCC_INSTALL_LINE)
+            message(FATAL_ERROR "Unable to determine GCC installation ${{TOOLCHAIN_GCC_INSTALL}} ${{TOOLCHAIN_GCC_INSTALL_ERROR}}")
+        endif()
+        cmake_path(SET TOOLCHAIN_GCC_INSTALL_LIB NORMALIZE ${{CMAKE_MATCH_2}})
     endif()
-    cmake_path(SET TOOLCHAIN_GCC_INSTALL_LIB NORMALIZE ${{CMAKE_MATCH_2}})
-    cmake_path(SET TOOLCHAIN_GCC_INSTALL NORMALIZE ${{CMAKE_MATCH_2}})
+    set(CROSS_GNU_TRIPLE_EFFECTIVE ${{CROSS_GNU_TRIPLE_EFFECTIVE}}
+        CACHE STRING "The GNU triple of the toolchain actually in use")
+    set(TOOLCHAIN_GCC_INSTALL_LIB ${{TOOLCHAIN_GCC_INSTALL_LIB}}
+        CACHE INTERNAL "Path to the GCC installation's library folder")
+    cmake_path(SET TOOLCHAIN_GCC_INSTALL NORMALIZE ${{TOOLCHAIN_GCC_INSTALL_LIB}})
     cmake_path(APPEND TOOLCHAIN_GCC_INSTALL "../../../..")
     cmake_path(ABSOLUTE_PATH TOOLCHAIN_GCC_INSTALL)
     set(TOOLCHAIN_GCC_INSTALL ${{TOOLCHAIN_GCC_INSTALL}}
@@ -144,39 +161,39 @@ endif()
 
 # Locating Python
 option(TOOLCHAIN_NO_PYTHON "Don't change any hints to FindPython" Off)
+set(TOOLCHAIN_PYTHON_ABIFLAGS "" CACHE STRING
+    "ABI flags of the Python to use, e.g. t for the free-threaded build (default: those of the build Python)")
 
 function(toolchain_locate_python prefix)
-    execute_process (COMMAND "${{${{prefix}}_EXECUTABLE}}" -c
-                             "import sys; print('.'.join(map(str, sys.version_info[:2])))"
-                     RESULT_VARIABLE result
-                     OUTPUT_VARIABLE version
-                     OUTPUT_STRIP_TRAILING_WHITESPACE)
-    if (result)
-        message(FATAL_ERROR "Unable to determine Python version")
-    endif()
-    execute_process (COMMAND "${{${{prefix}}_EXECUTABLE}}" -c
-                             "import sys; print('.'.join(map(str, sys.implementation.version[:2])))"
-                     RESULT_VARIABLE result
-                     OUTPUT_VARIABLE impl_version
-                     OUTPUT_STRIP_TRAILING_WHITESPACE)
-    if (result)
-        message(FATAL_ERROR "Unable to determine Python implementation version")
+    # Query the version, implementation version, ABI flags and implementation
+    # of the build Python in one go, and cache them for this executable
+    set(python "${{${{prefix}}_EXECUTABLE}}")
+    if (NOT "${{TOOLCHAIN_${{prefix}}_INFO_EXECUTABLE}}" STREQUAL "${{python}}")
+        execute_process (COMMAND "${{python}}" -c
+                                 "import sys; v = sys.version_info; i = sys.implementation; print('%d.%d;%d.%d;%s;%s' % (v[0], v[1], i.version[0], i.version[1], sys.abiflags, i.name))"
+                         RESULT_VARIABLE result
+                         OUTPUT_VARIABLE info
+                         OUTPUT_STRIP_TRAILING_WHITESPACE)
+        if (result)
+            message(FATAL_ERROR "Unable to determine Python version, "
+                "implementation and ABI flags")
+        endif()
+        set(TOOLCHAIN_${{prefix}}_INFO "${{info}}" CACHE INTERNAL
+            "Version, implementation version, ABI flags and implementation of the build Python")
+        set(TOOLCHAIN_${{prefix}}_INFO_EXECUTABLE "${{python}}" CACHE INTERNAL
+            "Executable that TOOLCHAIN_${{prefix}}_INFO belongs to")
     endif()
-    execute_process (COMMAND "${{${{prefix}}_EXECUTABLE}}" -c
-                             "import sys; print(sys.abiflags)"
-                     RESULT_VARIABLE result
-                     OUTPUT_VARIABLE abi
-                     OUTPUT_STRIP_TRAILING_WHITESPACE)
-    if (result)
-        message(FATAL_ERROR "Unable to determine Python ABI flags")
+    # (The ABI flags may be empty, which list(GET) does not handle well)
+    if (NOT TOOLCHAIN_${{prefix}}_INFO MATCHES "^([^;]*);([^;]*);([^;]*);([^;]*)$")
+        message(FATAL_ERROR "Unexpected Python information "
+            "(${{TOOLCHAIN_${{prefix}}_INFO}})")
     endif()
-    execute_process (COMMAND "${{${{prefix}}_EXECUTABLE}}" -c
-                             "import sys; print(sys.implementation.name)"
-                     RESULT_VARIABLE result
-                     OUTPUT_VARIABLE implementation
-                     OUTPUT_STRIP_TRAILING_WHITESPACE)
-    if (result)
-        message(FATAL_ERROR "Unable to determine Python implementation")
+    set(version ${{CMAKE_MATCH_1}})
+    set(impl_version ${{CMAKE_MATCH_2}})
+    set(abi "${{CMAKE_MATCH_3}}")
+    set(implementation ${{CMAKE_MATCH_4}})
+    if (TOOLCHAIN_PYTHON_ABIFLAGS)
+        set(abi "${{TOOLCHAIN_PYTHON_ABIFLAGS}}")
     endif()
     if (implementation STREQUAL "pypy")
         set(lib_version "${{version}}")
@@ -194,8 +211,13 @@ function(toolchain_locate_python prefix)
         list(APPEND CMAKE_FIND_ROOT_PATH "${{python_dir}}")
         set(TOOLCHAIN_${{prefix}}_EXT_SUFFIX ".pypy${{version}}-pp${{impl_version}}-${{CMAKE_SYSTEM_PROCESSOR}}-linux-gnu.so")
         set(TOOLCHAIN_${{prefix}}_DEBUG_ABI FALSE)
+        set(TOOLCHAIN_${{prefix}}_FREE_THREADED FALSE)
     elseif(implementation STREQUAL "cpython")
+        # The free-threaded build is staged as python3.xt
         set(python_dir "${{CMAKE_CURRENT_LIST_DIR}}/python${{version}}")
+        if (abi MATCHES "t")
+            string(APPEND python_dir "t")
+        endif()
         set(${{prefix}}_ROOT_DIR "${{python_dir}}/usr/local")
         set(${{prefix}}_LIBRARY "${{python_dir}}/usr/local/lib/libpython${{version}}${{abi}}.so")
         set(${{prefix}}_INCLUDE_DIR "${{python_dir}}/usr/local/include/python${{version}}${{abi}}")
@@ -212,26 +234,41 @@ function(toolchain_locate_python prefix)
             ONLY_CMAKE_FIND_ROOT_PATH)
         set(TOOLCHAIN_${{prefix}}_CONFIG ${{TOOLCHAIN_${{prefix}}_CONFIG}}
             CACHE FILEPATH "Path of the python3.x-config script")
-        # Query the python3.x-config script for the extension suffix:
-        execute_process(COMMAND ${{TOOLCHAIN_${{prefix}}_CONFIG}}
-            --extension-suffix
-            OUTPUT_VARIABLE TOOLCHAIN_${{prefix}}_EXT_SUFFIX
-            OUTPUT_STRIP_TRAILING_WHITESPACE
-            RESULT_VARIABLE result)
-        if (NOT result EQUAL 0 OR NOT TOOLCHAIN_${{prefix}}_EXT_SUFFIX)
-            message(FATAL_ERROR "Unable to determine extension suffix:"
-                "\\nTOOLCHAIN_${{prefix}}_EXT_SUFFIX")
-        endif()
-        # Query the python3.x-config script for the ABI flags:
-        execute_process(COMMAND ${{TOOLCHAIN_${{prefix}}_CONFIG}}
-            --abiflags
-            OUTPUT_VARIABLE TOOLCHAIN_${{prefix}}_ABIFLAGS
-            OUTPUT_STRIP_TRAILING_WHITESPACE
-            RESULT_VARIABLE result)
-        # Report errors:
-        if (NOT result EQUAL 0)
-            message(FATAL_ERROR "Unable to determine ABI flags:"
-                "\\n${{TOOLCHAIN_${{prefix}}_ABIFLAGS}}")
+        # The python3.x-config shell script contains the extension suffix and
+        # ABI flags as plain variables, so read them instead of running it:
+        file(STRINGS ${{TOOLCHAIN_${{prefix}}_CONFIG}} config_vars
+            REGEX "^(SO|ABIFLAGS)=\\"[^\\"]*\\"$")
+        unset(TOOLCHAIN_${{prefix}}_EXT_SUFFIX)
+        unset(TOOLCHAIN_${{prefix}}_ABIFLAGS)
+        foreach(line IN LISTS config_vars)
+            if (line MATCHES "^SO=\\"(.*)\\"$")
+                set(TOOLCHAIN_${{prefix}}_EXT_SUFFIX "${{CMAKE_MATCH_1}}")
+            elseif (line MATCHES "^ABIFLAGS=\\"(.*)\\"$")
+                set(TOOLCHAIN_${{prefix}}_ABIFLAGS "${{CMAKE_MATCH_1}}")
+            endif()
+        endforeach()
+        if (NOT TOOLCHAIN_${{prefix}}_EXT_SUFFIX)
+            # Query the python3.x-config script for the extension suffix:
+            execute_process(COMMAND ${{TOOLCHAIN_${{prefix}}_CONFIG}}
+                --extension-suffix
+                OUTPUT_VARIABLE TOOLCHAIN_${{prefix}}_EXT_SUFFIX
+                OUTPUT_STRIP_TRAILING_WHITESPACE
+                RESULT_VARIABLE result)
+            if (NOT result EQUAL 0 OR NOT TOOLCHAIN_${{prefix}}_EXT_SUFFIX)
+                message(FATAL_ERROR "Unable to determine extension suffix:"
+                    "\\nTOOLCHAIN_${{prefix}}_EXT_SUFFIX")
+            endif()
+            # Query the python3.x-config script for the ABI flags:
+            execute_process(COMMAND ${{TOOLCHAIN_${{prefix}}_CONFIG}}
+                --abiflags
+                OUTPUT_VARIABLE TOOLCHAIN_${{prefix}}_ABIFLAGS
+                OUTPUT_STRIP_TRAILING_WHITESPACE
+                RESULT_VARIABLE result)
+            # Report errors:
+            if (NOT result EQUAL 0)
+                message(FATAL_ERROR "Unable to determine ABI flags:"
+                    "\\n${{TOOLCHAIN_${{prefix}}_ABIFLAGS}}")
+            endif()
         endif()
         if (NOT "${{TOOLCHAIN_${{prefix}}_ABIFLAGS}}" STREQUAL "${{abi}}")
             message(WARNING "Build-Python and cross-Python ABI mismatch"
@@ -242,6 +279,11 @@ function(toolchain_locate_python prefix)
         else()
             set(TOOLCHAIN_${{prefix}}_DEBUG_ABI FALSE)
         endif()
+        if (TOOLCHAIN_${{prefix}}_ABIFLAGS MATCHES "t")
+            set(TOOLCHAIN_${{prefix}}_FREE_THREADED TRUE)
+        else()
+            set(TOOLCHAIN_${{prefix}}_FREE_THREADED FALSE)
+        endif()
     else()
         message(FATAL_ERROR "Unsupported Python implementation "
             "(${{implementation}})")
@@ -254,6 +296,8 @@ function(toolchain_locate_python prefix)
         CACHE STRING "Extension suffix for Python modules")
     set(TOOLCHAIN_${{prefix}}_DEBUG_ABI ${{TOOLCHAIN_${{prefix}}_DEBUG_ABI}}
         CACHE BOOL "Whether the Python uses the Debug ABI (Py_DEBUG)")
+    set(TOOLCHAIN_${{prefix}}_FREE_THREADED ${{TOOLCHAIN_${{prefix}}_FREE_THREADED}}
+        CACHE BOOL "Whether the Python is built without the GIL (Py_GIL_DISABLED)")
 endfunction()
 
 if (DEFINED Python3_EXECUTABLE AND NOT TOOLCHAIN_NO_PYTHON)
@@ -269,7 +313,8 @@ def get_cmake_toolchain_file(cfg: PlatformConfig):
     subs = {
         "CMAKE_SYSTEM_PROCESSOR": cmake_system_processor(cfg),
         "CMAKE_SYSTEM_NAME": cmake_system_name(cfg),
-        "CROSS_GNU_TRIPLE": str(cfg),
+        "TRIPLE": str(cfg),
+        "CROSS_GNU_TRIPLE": toolchain_triple(cfg),
         "CMAKE_LIBRARY_ARCHITECTURE": multiarch_lib_dir(cfg),
         "ARCH_FLAGS": arch_flags(cfg),
         "CPACK_DEBIAN_PACKAGE_ARCHITECTURE": cpack_debian_architecture(cfg),
@@ -277,9 +322,46 @@ def get_cmake_toolchain_file(cfg: PlatformConfig):
     return toolchain_contents.format(**subs)
 
 
+toolchain_info_contents = """\
+# Information about the GCC toolchain, used by {TRIPLE}.toolchain.cmake
+# so that it doesn't have to query GCC on every configure. Generated by
+# gen-cmake-toolchain.py.
+set(CROSS_GNU_TRIPLE_EFFECTIVE "{CROSS_GNU_TRIPLE_EFFECTIVE}")
+set(TOOLCHAIN_GCC_INSTALL_LIB "${{TOOLCHAIN_DIR}}/{TOOLCHAIN_GCC_INSTALL_LIB}")
+"""
+
+
+def get_toolchain_info_file(cfg: PlatformConfig, toolchain_file_dir: str):
+    """Query the GCC toolchain in the x-tools folder next to the toolchain
+    file. Paths are stored relative to the toolchain (which may be a link to
+    the shared toolchain store)."""
+    toolchain = toolchain_triple(cfg)
+    toolchain_dir = os.path.join(toolchain_file_dir, "x-tools", toolchain)
+    gcc = os.path.join(toolchain_dir, "bin", f"{toolchain}-gcc")
+    triple = run([gcc, "-dumpmachine"], stdout=PIPE, check=True,
+                 universal_newlines=True).stdout.strip()
+    search_dirs = run([gcc, "-print-search-dirs"], stdout=PIPE, check=True,
+                      universal_newlines=True).stdout
+    m = re.search(r"^install: +(.*)$", search_dirs, re.MULTILINE)
+    if not triple or not m:
+        raise RuntimeError(f"Unable to query GCC toolchain {gcc}")
+    install = os.path.relpath(os.path.realpath(m.group(1)),
+                              os.path.realpath(toolchain_dir))
+    subs = {
+        "TRIPLE": str(cfg),
+        "CROSS_GNU_TRIPLE_EFFECTIVE": triple,
+        "TOOLCHAIN_GCC_INSTALL_LIB": install,
+    }
+    return toolchain_info_contents.format(**subs)
+
+
 if __name__ == "__main__":
-    triple = sys.argv[1]
-    outfile = sys.argv[2]
+    info = sys.argv[1] == "--info"
+    triple, outfile = sys.argv[1 + info:3 + info]
     cfg = PlatformConfig.from_string(triple)
+    if info:
+        contents = get_toolchain_info_file(cfg, os.path.dirname(outfile))
+    else:
+        contents = get_cmake_toolchain_file(cfg)
     with open(outfile, "w") as f:
-        f.write(get_cmake_toolchain_file(cfg))
+        f.write(contents)
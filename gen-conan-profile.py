@@ -3,6 +3,7 @@ from platform_config import (
     PlatformConfig,
     conan_arch,
     arch_flags,
+    toolchain_triple,
 )
 
 cross_config_contents = """\
@@ -17,18 +18,31 @@ os=Linux
 
 [conf]
 tools.cmake.cmaketoolchain:user_toolchain=["{{{{ os.path.join(profile_dir, "{triple}.toolchain.cmake") }}}}"]
-tools.gnu:host_triplet="{triple}"
-tools.build:sysroot="{{{{ os.path.join(profile_dir, "x-tools/{triple}/{triple}/sysroot") }}}}"
+tools.gnu:host_triplet="{toolchain}"
+tools.build:sysroot="{{{{ os.path.join(profile_dir, "x-tools/{toolchain}/{toolchain}/sysroot") }}}}"
 tools.build:cflags={arch_flags}
 tools.build:cxxflags={arch_flags}
-tools.build:compiler_executables={{ "c": "{{{{ os.path.join(profile_dir, "x-tools/{triple}/bin/{triple}-gcc") }}}}", "cpp": "{{{{ os.path.join(profile_dir, "x-tools/{triple}/bin/{triple}-g++") }}}}", "fortran": "{{{{ os.path.join(profile_dir, "x-tools/{triple}/bin/{triple}-gfortran") }}}}" }}
+tools.build:compiler_executables={{ "c": "{{{{ os.path.join(profile_dir, "x-tools/{toolchain}/bin/{toolchain}-gcc") }}}}", "cpp": "{{{{ os.path.join(profile_dir, "x-tools/{toolchain}/bin/{toolchain}-g++") }}}}", "fortran": "{{{{ os.path.join(profile_dir, "x-tools/{toolchain}/bin/{toolchain}-gfortran") }}}}" }}
 """
 
+# Profile for packages that use the free-threaded build of Python (python3.xt)
+free_threaded_contents = """\
+include({triple}.conan.profile)
+
+[conf]
+tools.cmake.cmaketoolchain:extra_variables={{ "TOOLCHAIN_PYTHON_ABIFLAGS": "t" }}
+"""
+
+
+def get_free_threaded_profile(cfg: PlatformConfig):
+    return free_threaded_contents.format(triple=str(cfg))
+
 
 def get_py_build_cmake_cross_config(cfg: PlatformConfig):
     subs = {
         "arch": conan_arch(cfg),
         "triple": str(cfg),
+        "toolchain": toolchain_triple(cfg),
         "arch_flags": arch_flags(cfg).split()
     }
     return cross_config_contents.format(**subs)
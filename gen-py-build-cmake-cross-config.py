@@ -12,6 +12,26 @@ arch = '{arch}'
 toolchain_file = '{triple}.toolchain.cmake'
 """
 
+# Versions of CPython with a free-threaded build (python3.13t), which get a
+# configuration of their own, e.g. <triple>.py-build-cmake.cross.cp313t.toml.
+# The ABI is selected explicitly, so the build Python doesn't have to be a
+# free-threaded one.
+FREE_THREADED_VERSIONS = ["3.13"]
+
+free_threaded_config_contents = """\
+# For more information, see
+# https://tttapa.github.io/py-build-cmake/Cross-compilation.html
+
+implementation = 'cp'
+version = '{version}'
+abi = 'cp{version}t'
+arch = '{arch}'
+toolchain_file = '{triple}.toolchain.cmake'
+
+[cmake.options]
+TOOLCHAIN_PYTHON_ABIFLAGS = 't'
+"""
+
 
 def get_py_build_cmake_cross_config(cfg: PlatformConfig):
     subs = {
@@ -21,6 +41,20 @@ def get_py_build_cmake_cross_config(cfg: PlatformConfig):
     return cross_config_contents.format(**subs)
 
 
+def get_free_threaded_configs(cfg: PlatformConfig):
+    """The configurations for the free-threaded builds, by file name."""
+    configs = {}
+    for v in FREE_THREADED_VERSIONS:
+        subs = {
+            "version": v.replace(".", ""),
+            "arch": python_arch(cfg),
+            "triple": str(cfg),
+        }
+        name = f"{cfg}.py-build-cmake.cross.cp{subs['version']}t.toml"
+        configs[name] = free_threaded_config_contents.format(**subs)
+    return configs
+
+
 if __name__ == "__main__":
     triple = sys.argv[1]
     outfile = sys.argv[2]
@@ -0,0 +1,75 @@
+import importlib.util
+import os
+from pathlib import Path
+import sys
+from typing import Iterable
+
+from platform_config import PlatformConfig
+
+this_dir = Path(__file__).parent
+
+
+def _load(name: str):
+    # The generator scripts have dashes in their names, so they can't be
+    # imported normally
+    path = this_dir / f"{name}.py"
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"),
+                                                  path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+_cmake_toolchain = _load("gen-cmake-toolchain")
+_py_build_cmake = _load("gen-py-build-cmake-cross-config")
+_conan = _load("gen-conan-profile")
+
+
+def config_files(cfg: PlatformConfig):
+    """The configuration files for the given platform, mapping file names to
+    their contents."""
+    return {
+        f"{cfg}.toolchain.cmake":
+        _cmake_toolchain.get_cmake_toolchain_file(cfg),
+        f"{cfg}.py-build-cmake.cross.toml":
+        _py_build_cmake.get_py_build_cmake_cross_config(cfg),
+        **_py_build_cmake.get_free_threaded_configs(cfg),
+        f"{cfg}.conan.profile":
+        _conan.get_py_build_cmake_cross_config(cfg),
+        f"{cfg}.freethreaded.conan.profile":
+        _conan.get_free_threaded_profile(cfg),
+    }
+
+
+def write_if_changed(path: Path, contents: str) -> bool:
+    """Write the file only if its contents changed, so that its modification
+    time (and therefore everything that depends on it) is left alone
+    otherwise."""
+    try:
+        if path.read_text() == contents:
+            return False
+    except FileNotFoundError:
+        pass
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(contents)
+    os.replace(tmp, path)
+    return True
+
+
+def generate(triples: Iterable[str], staging_dir: Path, build_dir: Path):
+    """Write the CMake toolchain file, py-build-cmake cross-compilation config
+    and Conan profile for each triple to staging_dir/<triple>, and touch the
+    stamp file in build_dir/<triple> that the Makefile uses to track them."""
+    for triple in triples:
+        cfg = PlatformConfig.from_string(triple)
+        for name, contents in config_files(cfg).items():
+            if write_if_changed(staging_dir / triple / name, contents):
+                print(f"Generated {staging_dir / triple / name}")
+        stamp = build_dir / triple / "configs.stamp"
+        stamp.parent.mkdir(parents=True, exist_ok=True)
+        stamp.touch()
+
+
+if __name__ == "__main__":
+    generate(sys.argv[1:], this_dir / "staging", this_dir / "build")
@@ -0,0 +1,313 @@
+import argparse
+from io import BytesIO
+import json
+from multiprocessing.pool import ThreadPool
+import os
+from pathlib import Path
+import re
+import stat
+from subprocess import PIPE, Popen
+import sys
+import tarfile
+from typing import Dict, List, Optional, Tuple
+
+from artifact_cache import file_digest, is_external_link, staging_links
+from build import BLAS_FLAVOURS, BLAS_TARGETS, NOARCH, TARGET_DEPENDENCIES
+
+this_dir = Path(__file__).parent
+
+MANIFEST_NAME = "manifest.sha256"
+
+# Component with the loose files in the staging directory (CMake toolchain
+# file, py-build-cmake configuration, Conan profile), which all other
+# components need
+CONFIG_COMPONENT = "config"
+
+# Compressors by archive extension. Both compress (and zstd also decompresses)
+# using all cores.
+COMPRESSORS = {
+    ".tar.zst": lambda level: ["zstd", "-T0", f"-{level}", "--long=27", "-q"],
+    ".tar.xz": lambda level: ["xz", "-T0", f"-{min(level, 9)}"],
+}
+
+
+def archive_format(path: Path) -> str:
+    for ext in COMPRESSORS:
+        if path.name.endswith(ext):
+            return ext
+    raise ValueError(f"Unsupported archive format: {path.name} (expected "
+                     + " or ".join(COMPRESSORS) + ")")
+
+
+def noarch_package(root: Path, name: str) -> Optional[str]:
+    """The package in the architecture-independent staging directory that the
+    given entry of the staging directory links to, if any."""
+    path = root / name
+    if not path.is_symlink():
+        return None
+    parts = Path(os.readlink(path)).parts
+    if len(parts) == 3 and parts[:2] == ("..", NOARCH):
+        return parts[2]
+    return None
+
+
+def tree(path: Path, base: Path) -> List[Path]:
+    """All files, directories and symbolic links in the given directory,
+    sorted, relative to ``base``."""
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        rel = Path(dirpath).relative_to(base)
+        dirnames.sort()
+        entries += [rel / n for n in sorted(dirnames + filenames)]
+    return entries
+
+
+def walk(root: Path, names: List[str]) -> List[Path]:
+    """The given top-level entries of the directory and everything in them,
+    relative to the directory's parent. Architecture-independent packages
+    that they link to are included as well, and so are the contents of
+    directories outside of the staging directory that they link to (e.g. the
+    toolchain in the shared store)."""
+    base = root.parent
+    entries = [Path(root.name)]
+    noarch = []
+    for name in sorted(names):
+        entries.append(Path(root.name) / name)
+        pkg = noarch_package(root, name)
+        if pkg is not None:
+            noarch.append(pkg)
+        elif (root / name).is_dir() and (not (root / name).is_symlink()
+                                         or is_external_link(root / name)):
+            entries += tree(root / name, base)
+    if noarch:
+        entries.append(Path(NOARCH))
+    for pkg in sorted(noarch):
+        entries.append(Path(NOARCH) / pkg)
+        entries += tree(base / NOARCH / pkg, base)
+    return entries
+
+
+def top_level(root: Path, exclude: List[str]) -> List[str]:
+    """The entries of the directory, except for the excluded ones and a
+    manifest from an archive that was extracted into it earlier."""
+    return [n for n in sorted(os.listdir(root))
+            if n not in exclude and n != MANIFEST_NAME]
+
+
+def normalize(info: tarfile.TarInfo) -> tarfile.TarInfo:
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    return info
+
+
+def package(triple: str, output: Path, names: List[str], dedup: bool,
+            level: int, jobs: int, manifest: bool = True):
+    """Write the given entries of the staging directory of the triple to a
+    compressed archive, optionally with a manifest of the SHA-256 hashes of
+    all files. If ``dedup`` is set, files with the same contents are only
+    stored once, as hard links."""
+    root = this_dir / "staging" / triple
+    base = root.parent
+    entries = walk(root, names)
+    files = [e for e in entries if (base / e).is_file()
+             and not (base / e).is_symlink()]
+    with ThreadPool(jobs) as pool:
+        digests = dict(zip(files, pool.map(lambda e: file_digest(base / e),
+                                           files, chunksize=16)))
+
+    ext = archive_format(output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    tmp = output.with_name(output.name + ".tmp")
+    first: Dict[Tuple[str, int], Path] = {}
+    saved = 0
+    with open(tmp, "wb") as f:
+        proc = Popen(COMPRESSORS[ext](level), stdin=PIPE, stdout=f)
+        with tarfile.open(fileobj=proc.stdin, mode="w|",
+                          format=tarfile.PAX_FORMAT) as tar:
+            for e in entries:
+                path = base / e
+                if is_external_link(path):  # Store the directory itself
+                    path = Path(os.path.realpath(path))
+                info = normalize(tar.gettarinfo(str(path), str(e)))
+                if info.isreg():
+                    key = (digests[e], stat.S_IMODE(info.mode))
+                    if dedup and key in first:
+                        info.type = tarfile.LNKTYPE
+                        info.linkname = str(first[key])
+                        saved += info.size
+                        info.size = 0
+                        tar.addfile(info)
+                        continue
+                    first.setdefault(key, e)
+                    with open(path, "rb") as src:
+                        tar.addfile(info, src)
+                else:
+                    tar.addfile(info)
+            if manifest:
+                data = "".join(f"{d}  {os.path.relpath(e, triple)}\n"
+                               for e, d in digests.items()).encode()
+                info = normalize(tarfile.TarInfo(f"{triple}/{MANIFEST_NAME}"))
+                info.size = len(data)
+                info.mtime = int(os.stat(root).st_mtime)
+                tar.addfile(info, BytesIO(data))
+        proc.stdin.close()
+        if proc.wait() != 0:
+            raise RuntimeError(f"Compressing {output} failed")
+    os.replace(tmp, output)
+    print(f"Wrote {output} ({len(files)} files, "
+          f"{output.stat().st_size / 2**20:.1f} MiB"
+          + (f", {saved / 2**20:.1f} MiB deduplicated" if dedup else "") +
+          ")")
+
+
+def component_target(name: str) -> str:
+    """The Makefile target that produces the given component, e.g. python for
+    python3.11, or openblas for openblas-dynamic."""
+    m = re.match(r'^(python|pypy)-?\d', name, re.IGNORECASE)
+    if m:
+        return m.group(1).lower()
+    return blas_flavour(name)[0]
+
+
+def blas_flavour(name: str) -> Tuple[str, str]:
+    """Split the name of a component into the name of the default variant and
+    the suffix of its BLAS flavour, e.g. ("mumps", "-dynamic")."""
+    for flavour in filter(None, BLAS_FLAVOURS.values()):
+        base = name[:-len(flavour) - 1]
+        if name == f"{base}-{flavour}" and base in BLAS_TARGETS:
+            return base, f"-{flavour}"
+    return name, ""
+
+
+def components(root: Path, exclude: List[str]) -> Dict[str, List[str]]:
+    """Split the staging directory into components: every package directory
+    (or link to an architecture-independent package) together with the
+    symbolic links to it, named after the shortest link (e.g. python3.11 for
+    Python-3.11.10 and python3.11), and the remaining files. Returns the
+    top-level entries of each component."""
+    names = top_level(root, exclude)
+    result: Dict[str, List[str]] = {}
+    for n in names:
+        path = root / n
+        if noarch_package(root, n) is not None or is_external_link(path) \
+                or path.is_dir() and not path.is_symlink():
+            links = [l for l in staging_links(root, n) if l in names]
+            name = min(links, key=lambda l: (len(l), l)) if links else n
+            result[name] = [n] + links
+    grouped = {m for members in result.values() for m in members}
+    config = [n for n in names if n not in grouped]
+    if config:
+        result[CONFIG_COMPONENT] = config
+    return result
+
+
+def dependencies(name: str, available: List[str]) -> List[str]:
+    """Components that the given component needs, derived from the
+    dependencies between the Makefile targets. The toolchain is not included,
+    since it is only needed to build other software."""
+    if name in (CONFIG_COMPONENT, "x-tools"):
+        return []
+    _, suffix = blas_flavour(name)
+    deps = TARGET_DEPENDENCIES.get(component_target(name), [])
+    # Components of a BLAS flavour need the other components of that flavour
+    deps = [d + suffix if d in BLAS_TARGETS else d for d in deps]
+    deps = [d for d in deps if d in available and d != name]
+    if CONFIG_COMPONENT in available:
+        deps.append(CONFIG_COMPONENT)
+    return deps
+
+
+def index_name(triple: str) -> str:
+    return f"index-{triple}.json"
+
+
+def package_components(triple: str, output_dir: Path, exclude: List[str],
+                       dedup: bool, level: int, jobs: int):
+    """Write each component of the staging directory of the given triple to
+    its own archive, and an index with the archives, their hashes and the
+    dependencies between the components."""
+    root = this_dir / "staging" / triple
+    comps = components(root, exclude)
+    index = {"triple": triple, "components": {}}
+    for name, members in comps.items():
+        archive = output_dir / f"{name}-{triple}.tar.zst"
+        package(triple, archive, members, dedup, level, jobs, manifest=False)
+        index["components"][name] = {
+            "archive": archive.name,
+            "sha256": file_digest(archive),
+            "size": archive.stat().st_size,
+            "members": members,
+            "depends": dependencies(name, list(comps)),
+        }
+    path = output_dir / index_name(triple)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(index, indent=2) + "\n")
+    os.replace(tmp, path)
+    print(f"Wrote {path} ({len(comps)} components)")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="build.py package",
+        description="Package the staging directory of a triple",
+        allow_abbrev=False,
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        required=True,
+        help="GNU triple to package",
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        type=Path,
+        help="Archive to write, .tar.zst or .tar.xz (default: "
+        "full-<triple>.tar.zst), or the directory to write the archives to "
+        "with --split (default: components)",
+    )
+    parser.add_argument(
+        "--split",
+        action='store_true',
+        help="Write every component (python3.11, openblas, x-tools, ...) to "
+        "its own archive, with an index for build.py fetch",
+    )
+    parser.add_argument(
+        "--without-toolchain",
+        action='store_true',
+        help="Don't include the toolchain (x-tools)",
+    )
+    parser.add_argument(
+        "--no-dedup",
+        dest="dedup",
+        action='store_false',
+        help="Store files with identical contents multiple times instead of "
+        "using hard links",
+    )
+    parser.add_argument(
+        "--level",
+        type=int,
+        default=15,
+        help="Compression level",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of files to hash in parallel",
+    )
+    args = parser.parse_args(argv)
+    root = this_dir / "staging" / args.host
+    if not root.is_dir():
+        sys.exit(f"Nothing to package for {args.host}")
+    exclude = ["x-tools"] if args.without_toolchain else []
+    jobs = max(1, args.jobs)
+    if args.split:
+        output_dir = args.output or Path("components")
+        package_components(args.host, output_dir, exclude, args.dedup,
+                           args.level, jobs)
+    else:
+        output = args.output or Path(f"full-{args.host}.tar.zst")
+        package(args.host, output, top_level(root, exclude), args.dedup,
+                args.level, jobs)
@@ -1,5 +1,8 @@
 from copy import copy
 import dataclasses
+import functools
+import os
+from typing import Dict, List
 import warnings
 
 
@@ -18,10 +21,194 @@ class PlatformConfig:
         return cls(*s.split("-"))
 
 
+@dataclasses.dataclass
+class PlatformInfo:
+    # Triple of the GCC toolchain to use, if it is not the platform's own (e.g.
+    # for platforms that only differ in tuning)
+    toolchain: str = ""
+    # Flags for the CPU of the platform, used for all C, C++ and Fortran code
+    arch_flags: str = ""
+    # Platform and architecture parts of the Python platform tag (default: the
+    # kernel and the CPU), e.g. manylinux_2_27 and aarch64
+    python_platform: str = ""
+    python_arch: str = ""
+    # Architecture in the multiarch library directory (default: the CPU)
+    multiarch_arch: str = ""
+    debian_arch: str = ""
+    conan_arch: str = ""
+    # OpenBLAS TARGET with the kernels for the CPU of the platform
+    openblas_target: str = ""
+    # OpenBLAS DYNAMIC_ARCH builds (only supported for x86-64 and AArch64):
+    # the baseline TARGET, which OpenBLAS always includes, and the other
+    # kernels that are selected at run time
+    openblas_dynamic_target: str = ""
+    openblas_dynamic_list: List[str] = dataclasses.field(default_factory=list)
+    # Whether GCC supports __float128, for FFTW's quad precision
+    fftw_quad: bool = False
+    # SIMD extensions to enable in FFTW (SSE, SSE2, AVX, AVX2, AVX512, NEON).
+    # x86 kernels are only used if the CPU supports them.
+    fftw_simd: List[str] = dataclasses.field(default_factory=list)
+
+
+# Properties of the supported CPUs, used for all platforms with that CPU unless
+# the platform overrides them in PLATFORMS.
+# CPUs without OpenBLAS DYNAMIC_ARCH kernels of their own use the closest ones,
+# e.g. Cortex-A72 uses the Cortex-A57 kernels, Cortex-A76 the Neoverse N1
+# kernels, and Zen 4 the Cooper Lake kernels.
+CPUS = {
+    "x86_64": {
+        "debian_arch": "amd64",
+        "conan_arch": "x86_64",
+        "openblas_target": "HASWELL",
+        "openblas_dynamic_target": "PRESCOTT",
+        "openblas_dynamic_list": ["NEHALEM", "SANDYBRIDGE", "HASWELL", "ZEN",
+                                  "SKYLAKEX", "COOPERLAKE"],
+        "fftw_quad": True,
+        "fftw_simd": ["SSE", "SSE2", "AVX", "AVX2"],
+    },
+    "aarch64": {
+        "debian_arch": "arm64",
+        "conan_arch": "armv8",
+        "openblas_target": "ARMV8",
+        "openblas_dynamic_target": "ARMV8",
+        "openblas_dynamic_list": ["CORTEXA53", "CORTEXA57", "NEOVERSEN1"],
+        "fftw_simd": ["NEON"],
+    },
+    "armv8": {
+        "python_arch": "armv7l",
+        "multiarch_arch": "arm",
+        "debian_arch": "armhf",
+        "conan_arch": "armv8_32",
+        "openblas_target": "ARMV7",
+        "fftw_simd": ["NEON"],
+    },
+    "armv7": {
+        "python_arch": "armv7l",
+        "multiarch_arch": "arm",
+        "debian_arch": "armhf",
+        "conan_arch": "armv7hf",
+        "openblas_target": "ARMV7",
+    },
+    "armv6": {
+        "python_arch": "armv6l",
+        "multiarch_arch": "arm",
+        "conan_arch": "armv6",
+        "openblas_target": "ARMV6",
+    },
+    "arm": {
+        "python_arch": "armv7l",
+        "debian_arch": "armhf",
+    },
+}
+
+# Properties of the supported platforms, by GNU triple
+PLATFORMS = {
+    "x86_64-centos7-linux-gnu": {
+        "python_platform": "manylinux_2_17",
+    },
+    "x86_64-v3-linux-gnu": {
+        "toolchain": "x86_64-centos7-linux-gnu",
+        "arch_flags": "-march=x86-64-v3",
+        "python_platform": "manylinux_2_17",
+        "openblas_target": "HASWELL",
+    },
+    "x86_64-v4-linux-gnu": {
+        "toolchain": "x86_64-centos7-linux-gnu",
+        "arch_flags": "-march=x86-64-v4",
+        "python_platform": "manylinux_2_17",
+        "openblas_target": "SKYLAKEX",
+        "fftw_simd": ["SSE", "SSE2", "AVX", "AVX2", "AVX512"],
+    },
+    "aarch64-rpi3-linux-gnu": {
+        "arch_flags": "-mcpu=cortex-a53+crc+simd",
+        "python_platform": "manylinux_2_27",
+        "openblas_target": "CORTEXA53",
+    },
+    "aarch64-rpi4-linux-gnu": {
+        "toolchain": "aarch64-rpi3-linux-gnu",
+        "arch_flags": "-mcpu=cortex-a72",
+        "python_platform": "manylinux_2_27",
+        "openblas_target": "CORTEXA72",
+    },
+    "aarch64-rpi5-linux-gnu": {
+        "toolchain": "aarch64-rpi3-linux-gnu",
+        "arch_flags": "-mcpu=cortex-a76",
+        "python_platform": "manylinux_2_27",
+        "openblas_target": "NEOVERSEN1",
+    },
+    "armv8-rpi3-linux-gnueabihf": {
+        "arch_flags": "-mcpu=cortex-a53 -mfpu=neon-fp-armv8 -mfloat-abi=hard",
+        "python_platform": "manylinux_2_27",
+    },
+    "armv7-neon-linux-gnueabihf": {
+        "python_platform": "manylinux_2_27",
+        "fftw_simd": ["NEON"],
+    },
+    "armv6-rpi-linux-gnueabihf": {
+        "arch_flags": "-mcpu=arm1176jzf-s -mfpu=vfp -mfloat-abi=hard",
+        "python_platform": "linux",
+        "debian_arch": "armhf",
+    },
+}
+
+# TOML file with additional CPUs and platforms (or changes to the ones above),
+# with the same structure, e.g.
+#   [platforms.aarch64-rpi4-linux-gnu]
+#   toolchain = "aarch64-rpi3-linux-gnu"
+#   arch_flags = "-mcpu=cortex-a72"
+PLATFORMS_FILE_ENV = "CROSS_PYTHON_PLATFORMS"
+
+
+def load_toml(path: str) -> dict:
+    try:
+        import tomllib
+    except ImportError:
+        try:
+            import tomli as tomllib
+        except ImportError:
+            raise ImportError(f"Reading {path} requires Python 3.11 or the "
+                              "tomli package") from None
+    with open(path, "rb") as f:
+        return tomllib.load(f)
+
+
+@functools.lru_cache(maxsize=None)
+def platform_table():
+    """The CPUs and platforms, including the ones from the file given by the
+    CROSS_PYTHON_PLATFORMS environment variable."""
+    cpus = {k: copy(v) for k, v in CPUS.items()}
+    platforms = {k: copy(v) for k, v in PLATFORMS.items()}
+    path = os.environ.get(PLATFORMS_FILE_ENV)
+    if path:
+        data = load_toml(path)
+        for name, entry in data.get("cpus", {}).items():
+            cpus.setdefault(name, {}).update(entry)
+        for name, entry in data.get("platforms", {}).items():
+            platforms.setdefault(name, {}).update(entry)
+    return cpus, platforms
+
+
+def known_platforms() -> List[str]:
+    return list(platform_table()[1])
+
+
+def platform_info(cfg: PlatformConfig) -> PlatformInfo:
+    cpus, platforms = platform_table()
+    props: Dict[str, object] = {}
+    props.update(cpus.get(cfg.cpu, {}))
+    props.update(platforms.get(str(cfg), {}))
+    try:
+        return PlatformInfo(**props)
+    except TypeError as e:
+        raise ValueError(f"Invalid properties for platform {cfg}: {e}")
+
+
+def toolchain_triple(cfg: PlatformConfig):
+    return platform_info(cfg).toolchain or str(cfg)
+
+
 def multiarch_lib_dir(cfg: PlatformConfig):
-    arch = cfg.cpu
-    if arch.startswith("armv"):
-        arch = "arm"
+    arch = platform_info(cfg).multiarch_arch or cfg.cpu
     return "-".join((arch, cfg.kernel, cfg.system))
 
 
@@ -34,63 +221,55 @@ def cmake_system_name(cfg: PlatformConfig):
 
 
 def arch_flags(cfg: PlatformConfig):
-    flags = {
-        "rpi": {
-            "armv6": "-mcpu=arm1176jzf-s -mfpu=vfp -mfloat-abi=hard",
-        },
-        "rpi3": {
-            "aarch64": "-mcpu=cortex-a53+crc+simd",
-            "armv8": "-mcpu=cortex-a53 -mfpu=neon-fp-armv8 -mfloat-abi=hard",
-        },
-    }
-    return flags.get(cfg.vendor, {}).get(cfg.cpu, "")
+    return platform_info(cfg).arch_flags
+
+
+def openblas_target(cfg: PlatformConfig):
+    return platform_info(cfg).openblas_target
+
+
+def openblas_dynamic_target(cfg: PlatformConfig):
+    return platform_info(cfg).openblas_dynamic_target
+
+
+def openblas_dynamic_list(cfg: PlatformConfig):
+    """OpenBLAS DYNAMIC_LIST, as a CMake list."""
+    return ";".join(platform_info(cfg).openblas_dynamic_list)
+
+
+def fftw_quad(cfg: PlatformConfig):
+    return platform_info(cfg).fftw_quad
+
+
+def fftw_simd(cfg: PlatformConfig):
+    return " ".join(platform_info(cfg).fftw_simd)
 
 
 def cpack_debian_architecture(cfg: PlatformConfig):
-    archs = {
-        # "armv6": "armel"
-        "arm": "armhf",
-        "armv7": "armhf",
-        "armv8": "armhf",
-        "aarch64": "arm64",
-        "x86_64": "amd64",
-    }
-    arch = archs.get(cfg.cpu, "")
-    if not arch and cfg.cpu.startswith("arm") and cfg.vendor.startswith("rpi"):
-        arch = "armhf"
+    arch = platform_info(cfg).debian_arch
     if not arch:
         warnings.warn("Unknown Debian architecture")
     return arch
 
 
 def python_arch(cfg: PlatformConfig):
-    archs = {
-        "armv6": "armv6l",
-        "arm": "armv7l",
-        "armv7": "armv7l",
-        "armv8": "armv7l",
-    }
-    arch = archs.get(cfg.cpu) or cfg.cpu
+    info = platform_info(cfg)
+    arch = info.python_arch or cfg.cpu
     os = cfg.kernel
     if os == "linux":
-        os = {
-            "neon": "manylinux_2_27",
-            "rpi": "linux",
-            "rpi3": "manylinux_2_27",
-            "centos7": "manylinux_2_17",
-        }.get(cfg.vendor, os)
+        os = info.python_platform or os
     return "_".join((os, arch))
 
 
 def conan_arch(cfg: PlatformConfig):
-    archs = {
-        "armv6": "armv6",
-        "armv7": "armv7hf",
-        "armv8": "armv8_32",
-        "aarch64": "armv8",
-        "x86_64": "x86_64",
-    }
-    arch = archs.get(cfg.cpu, "")
+    arch = platform_info(cfg).conan_arch
     if not arch:
         warnings.warn("Unknown Conan architecture")
     return arch
+
+
+if __name__ == "__main__":
+    # Print a property of a platform, e.g. for use in the Makefile:
+    # python3 platform_config.py aarch64-rpi3-linux-gnu arch_flags
+    import sys
+    print(globals()[sys.argv[2]](PlatformConfig.from_string(sys.argv[1])))
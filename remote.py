@@ -0,0 +1,372 @@
+import argparse
+import dataclasses
+import json
+import os
+from pathlib import Path
+import re
+import shutil
+import socket
+import socketserver
+from subprocess import DEVNULL, PIPE, run
+import sys
+import tempfile
+import threading
+import time
+from typing import BinaryIO, Dict, List, Optional, Sequence
+
+from artifact_cache import compressor, is_external_link, staging_links
+from ccache import CCACHE_DIR_ENV, CcacheConfig
+from download import CHECKSUMS_FILE, Download, Downloader, read_checksums
+from timing import JobRecord, Stage, run_timed
+
+this_dir = Path(__file__).parent
+
+DEFAULT_PORT = 7390
+
+# Makefile variables that the coordinator may set for a job
+ALLOWED_OPTIONS = ["BUILD_TRIPLE", "HOST_TRIPLE", "TOOLCHAIN_TRIPLE",
+                   "FFTW_QUAD", "PYTHON_VERSION", "PYTHON_SUFFIX",
+                   "PYTHON_FLAVOUR", "BLAS_FLAVOUR", "BUILD_PYTHON", "JOBS",
+                   "PYPY_VERSION"]
+SAFE_VALUE = re.compile(r'^[A-Za-z0-9._+-]*$')
+
+
+def send(f: BinaryIO, msg: dict, payload: Optional[Path] = None):
+    """Send a JSON message on a single line, optionally followed by the
+    contents of a file (whose size is added to the message)."""
+    if payload is not None:
+        msg = dict(msg, size=payload.stat().st_size)
+    f.write(json.dumps(msg).encode() + b"\n")
+    if payload is not None:
+        with open(payload, "rb") as p:
+            shutil.copyfileobj(p, f, 1 << 20)
+    f.flush()
+
+
+def receive(f: BinaryIO) -> dict:
+    line = f.readline()
+    if not line:
+        raise ConnectionError("Connection closed unexpectedly")
+    return json.loads(line)
+
+
+def receive_payload(f: BinaryIO, size: int, dest: Path):
+    with open(dest, "wb") as d:
+        while size > 0:
+            chunk = f.read(min(size, 1 << 20))
+            if not chunk:
+                raise ConnectionError("Connection closed unexpectedly")
+            d.write(chunk)
+            size -= len(chunk)
+
+
+def git_revision(repo: Path) -> str:
+    res = run(["git", "rev-parse", "HEAD"], cwd=repo, stdout=PIPE,
+              stderr=DEVNULL, universal_newlines=True)
+    return res.stdout.strip() if res.returncode == 0 else ""
+
+
+def parse_address(address: str):
+    host, _, port = address.rpartition(":")
+    return host or "localhost", int(port or DEFAULT_PORT)
+
+
+# Worker
+
+
+def check_job(msg: dict):
+    """Make sure that the job only sets the allowed Makefile variables, only
+    refers to files in the repository, and only returns files from the
+    staging directory."""
+    for opt in msg["options"]:
+        name, _, value = opt.partition("=")
+        if name not in ALLOWED_OPTIONS or not SAFE_VALUE.match(value):
+            raise ValueError(f"Invalid option {opt!r}")
+    for target in msg["targets"]:
+        if not SAFE_VALUE.match(target) or target.startswith("-"):
+            raise ValueError(f"Invalid target {target!r}")
+    for old in msg["assume_old"]:
+        parts = Path(old).parts
+        if Path(old).is_absolute() or ".." in parts or \
+                not all(SAFE_VALUE.match(p) for p in parts):
+            raise ValueError(f"Invalid file {old!r}")
+    for out in msg["outputs"]:
+        parts = Path(out).parts
+        if Path(out).is_absolute() or ".." in parts or parts[0] != "staging":
+            raise ValueError(f"Invalid output {out!r}")
+    for path, url in msg.get("downloads", []):
+        parts = Path(path).parts
+        if Path(path).is_absolute() or ".." in parts or \
+                not all(SAFE_VALUE.match(p) for p in parts):
+            raise ValueError(f"Invalid download {path!r}")
+        if not url.startswith(("https://", "http://")):
+            raise ValueError(f"Invalid URL {url!r}")
+
+
+class Worker:
+    """Runs the jobs it receives from a coordinator in its own checkout of the
+    repository, streams their output back, and returns an archive with the
+    staged files they produced. The sources of a job are downloaded and
+    verified against the checksums in the repository before it is built."""
+
+    def __init__(self, repo: Path, mirror: Optional[Path] = None,
+                 ccache: Optional[CcacheConfig] = None):
+        self.repo = repo.resolve()
+        self.mirror = mirror
+        self.ccache = ccache
+        self.revision = git_revision(self.repo)
+        urls: Dict[str, str] = {}
+        checksums = read_checksums(self.repo / CHECKSUMS_FILE, urls)
+        self.downloader = Downloader(checksums, mirror, urls=urls)
+
+    def hello(self):
+        return {"type": "hello", "cpus": os.cpu_count(),
+                "revision": self.revision}
+
+    def archive(self, outputs: List[str], dest: Path):
+        members, external = [], []
+        for out in outputs:
+            path = self.repo / out
+            if not path.exists():
+                continue
+            if is_external_link(path):
+                # Archive the linked directory itself (e.g. the toolchain in
+                # the shared store), under the name of the link
+                real = Path(os.path.realpath(path))
+                external += [f"--transform=s|^{real.name}|{out}|S",
+                             "-C", str(real.parent), real.name]
+                continue
+            members.append(out)
+            members += [str(Path(out).parent / l)
+                        for l in staging_links(path.parent, path.name)]
+        if not members and not external:
+            # tar refuses to create an empty archive
+            members = ["--files-from=/dev/null"]
+        _, flags = compressor()
+        run(["tar", "-c", *flags, "-f", str(dest), "-C", str(self.repo),
+             *members, *external], check=True)
+
+    def download(self, downloads: Sequence[Sequence[str]]):
+        dls = [Download(self.repo / path, url) for path, url in downloads]
+        failed = self.downloader.run(dls, 4)
+        if failed:
+            raise RuntimeError("Download of " +
+                               ", ".join(d.path.name for d in failed) +
+                               " failed")
+
+    def run_job(self, msg: dict, f: BinaryIO):
+        check_job(msg)
+        name = msg["name"]
+        self.download(msg.get("downloads", []))
+        stages = self.repo / "build" / "trace" / (name.replace(" ", "_") +
+                                                   ".txt")
+        stages.parent.mkdir(parents=True, exist_ok=True)
+        cmd = ["make", "-C", str(self.repo), f"-j{int(msg['jobs'])}"]
+        cmd += [f"--assume-old={f}" for f in msg["assume_old"]]
+        cmd += msg["targets"] + msg["options"] + [f"BUILD_TRACE={stages}"]
+        if self.mirror is not None:
+            cmd += [f"DOWNLOAD_MIRROR={self.mirror.resolve()}"]
+        env = dict(os.environ, CMAKE_BUILD_PARALLEL_LEVEL=str(msg["jobs"]))
+        if self.ccache is not None:
+            options = dict(o.partition("=")[::2] for o in msg["options"])
+            env.update(self.ccache.env(options.get("HOST_TRIPLE", "")))
+        print(f"Building {name}")
+
+        def output(line):
+            send(f, {"type": "log", "line": line})
+
+        record = run_timed(name, cmd, env, stages, on_output=output,
+                           ccache_log=stages.with_suffix(".ccache"))
+        print(f"Finished {name} ({record.status})")
+        send(f, {"type": "result", "record": dataclasses.asdict(record)})
+        if record.status != 0:
+            return
+        ext, _ = compressor()
+        with tempfile.TemporaryDirectory() as tmp:
+            dest = Path(tmp) / f"outputs{ext}"
+            self.archive(msg["outputs"], dest)
+            send(f, {"type": "archive", "format": ext}, dest)
+
+
+class WorkerHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        worker: Worker = self.server.worker  # type: ignore
+        send(self.wfile, worker.hello())
+        try:
+            msg = receive(self.rfile)
+        except ConnectionError:
+            return  # The coordinator only asked for the hello message
+        try:
+            worker.run_job(msg, self.wfile)
+        except Exception as e:
+            send(self.wfile, {"type": "error", "message": str(e)})
+
+
+class WorkerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, worker: Worker):
+        super().__init__(address, WorkerHandler)
+        self.worker = worker
+
+
+def serve(address: str, repo: Path, mirror: Optional[Path] = None,
+          ccache: Optional[CcacheConfig] = None):
+    server = WorkerServer(parse_address(address),
+                          Worker(repo, mirror, ccache))
+    host, port = server.server_address[:2]
+    print(f"Worker for {repo.resolve()} listening on {host}:{port}")
+    with server:
+        server.serve_forever()
+
+
+# Coordinator
+
+
+class RemoteWorker:
+
+    def __init__(self, address: str):
+        self.address = parse_address(address)
+        with socket.create_connection(self.address) as sock:
+            hello = receive(sock.makefile("rb"))
+        self.cpus: int = hello["cpus"]
+        self.revision: str = hello["revision"]
+        self.triples: List[str] = []
+
+    def __str__(self):
+        return "{}:{}".format(*self.address)
+
+    def run(self, msg: dict, log: Optional[BinaryIO]) -> JobRecord:
+        start = time.time()
+        with socket.create_connection(self.address) as sock:
+            f = sock.makefile("rwb")
+            receive(f)  # hello
+            send(f, msg)
+            while True:
+                reply = receive(f)
+                if reply["type"] == "log":
+                    if log is not None:
+                        log.write(reply["line"].encode())
+                elif reply["type"] == "error":
+                    raise RuntimeError(f"Worker {self}: {reply['message']}")
+                elif reply["type"] == "result":
+                    record = reply["record"]
+                    if record["status"] != 0:
+                        break
+                elif reply["type"] == "archive":
+                    self.extract(f, reply, msg["outputs"])
+                    break
+        # Use the local clock for the timings of the job and its stages
+        offset = start - record["start"]
+        stages = [Stage(s["name"], s["target"], s["start"] + offset,
+                        s["end"] + offset, s["status"])
+                  for s in record["stages"]]
+        return JobRecord(msg["name"], start, time.time(), record["user"],
+                         record["sys"], record["maxrss"], record["status"],
+                         stages, record.get("ccache_hits", 0),
+                         record.get("ccache_misses", 0))
+
+    def extract(self, f: BinaryIO, reply: dict, outputs: List[str]):
+        flags = ["-I", "zstd -d"] if reply["format"] == ".tar.zst" else ["-z"]
+        with tempfile.TemporaryDirectory() as tmp:
+            archive = Path(tmp) / f"outputs{reply['format']}"
+            receive_payload(f, reply["size"], archive)
+            for out in outputs:
+                path = this_dir / out
+                if path.is_symlink() or path.is_file():
+                    path.unlink()
+                elif path.exists():
+                    shutil.rmtree(path)
+            run(["tar", "-x", *flags, "-f", str(archive), "-C",
+                 str(this_dir)], check=True)
+
+
+class WorkerPool:
+    """Distributes jobs over remote workers. All jobs for the same triple run
+    on the same worker, so that the dependencies of a job (e.g. the toolchain)
+    are always available on the worker that runs it."""
+
+    def __init__(self, addresses: List[str]):
+        self.workers = [RemoteWorker(a) for a in addresses]
+        self.lock = threading.Lock()
+        self.assigned: Dict[str, RemoteWorker] = {}
+        revision = git_revision(this_dir)
+        for w in self.workers:
+            if w.revision != revision:
+                raise RuntimeError(f"Worker {w} is at revision "
+                                   f"{w.revision or '?'}, expected {revision}")
+
+    @property
+    def cpus(self):
+        return sum(w.cpus for w in self.workers)
+
+    def worker_for(self, triple: str) -> RemoteWorker:
+        with self.lock:
+            if triple not in self.assigned:
+                w = min(self.workers,
+                        key=lambda w: (len(w.triples) / w.cpus, -w.cpus))
+                w.triples.append(triple)
+                self.assigned[triple] = w
+                print(f"Building {triple} on worker {w}")
+            return self.assigned[triple]
+
+    def run(self, name: str, triple: str, targets: List[str],
+            options: List[str], jobs: int, outputs: List[str],
+            assume_old: List[str], log: Optional[BinaryIO] = None,
+            downloads: Sequence[Download] = ()) -> JobRecord:
+        msg = {"type": "job", "name": name, "targets": targets,
+               "options": options, "jobs": jobs, "outputs": outputs,
+               "assume_old": assume_old,
+               "downloads": [(os.path.relpath(d.path, this_dir), d.url)
+                             for d in downloads]}
+        return self.worker_for(triple).run(msg, log)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="build.py worker",
+        description="Run build jobs for a coordinator (build.py --worker)",
+        allow_abbrev=False,
+    )
+    parser.add_argument(
+        "--listen",
+        type=str,
+        default=f"127.0.0.1:{DEFAULT_PORT}",
+        help="Address and port to listen on. Only use trusted networks.",
+    )
+    parser.add_argument(
+        "--repo",
+        type=Path,
+        default=this_dir,
+        help="Checkout of this repository to build in",
+    )
+    parser.add_argument(
+        "--mirror",
+        type=Path,
+        help="Copy source archives from this directory instead of "
+        "downloading them",
+    )
+    parser.add_argument(
+        "--ccache-dir",
+        type=Path,
+        default=os.environ.get(CCACHE_DIR_ENV),
+        help="Directory for the ccache caches of all triples (one "
+        "subdirectory per triple, default: ccache's own configuration)",
+    )
+    parser.add_argument(
+        "--ccache-size",
+        type=str,
+        default="5G",
+        help="Maximum size of the ccache cache of each triple (with "
+        "--ccache-dir)",
+    )
+    args = parser.parse_args(argv)
+    ccache = None
+    if args.ccache_dir:
+        ccache = CcacheConfig(args.ccache_dir, args.ccache_size)
+    try:
+        serve(args.listen, args.repo, args.mirror, ccache)
+    except KeyboardInterrupt:
+        sys.exit(130)
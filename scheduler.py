@@ -0,0 +1,255 @@
+import dataclasses
+import heapq
+from multiprocessing.pool import ThreadPool
+import queue
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+
+class Skipped(Exception):
+    """A node was not run because one of its dependencies failed, or because
+    the build was stopped after a failure."""
+
+
+@dataclasses.dataclass
+class Node:
+    key: Hashable
+    func: Callable[[], None]
+    deps: List[Hashable]
+    weight: int = 1
+    pool: Optional[Hashable] = None  # Tokens are also taken from this pool
+
+
+class _Tokens:
+    """The tokens that are free while running (or simulating) the nodes of a
+    scheduler, in total and of each pool."""
+
+    def __init__(self, scheduler: "Scheduler", tokens: int):
+        self.nodes = scheduler.nodes
+        self.pools = scheduler.pools
+        self.tokens = tokens
+        self.free = tokens
+        self.pool_free = dict(scheduler.pools)
+
+    def cost(self, key: Hashable) -> int:
+        """The number of tokens the node holds while it runs."""
+        node = self.nodes[key]
+        limit = self.pools.get(node.pool, self.tokens)
+        return max(1, min(node.weight, self.tokens, limit))
+
+    def fits(self, key: Hashable) -> bool:
+        pool = self.nodes[key].pool
+        return self.cost(key) <= self.free and \
+            (pool is None or self.cost(key) <= self.pool_free[pool])
+
+    def acquire(self, key: Hashable):
+        self._take(key, self.cost(key))
+
+    def release(self, key: Hashable):
+        self._take(key, -self.cost(key))
+
+    def _take(self, key: Hashable, count: int):
+        self.free -= count
+        pool = self.nodes[key].pool
+        if pool is not None:
+            self.pool_free[pool] -= count
+
+
+class Scheduler:
+    """Runs the nodes of a dependency graph, starting each node as soon as
+    all of its dependencies have finished and enough CPU tokens are free.
+    Nodes can also be assigned to a pool (e.g. the machine they run on) with
+    its own limit, in addition to the global one."""
+
+    def __init__(self):
+        self.nodes: Dict[Hashable, Node] = {}
+        self.pools: Dict[Hashable, int] = {}  # Number of tokens of each pool
+
+    def __contains__(self, key: Hashable):
+        return key in self.nodes
+
+    def add(self, key: Hashable, func: Callable[[], None],
+            deps: List[Hashable], weight: int = 1,
+            pool: Optional[Hashable] = None):
+        if key not in self.nodes:
+            self.nodes[key] = Node(key, func, list(deps), weight, pool)
+        return key
+
+    def add_pool(self, pool: Hashable, tokens: int):
+        self.pools[pool] = max(1, tokens)
+
+    def check(self):
+        for node in self.nodes.values():
+            for dep in node.deps:
+                if dep not in self.nodes:
+                    raise KeyError(f"{node.key} depends on unknown node {dep}")
+            if node.pool is not None and node.pool not in self.pools:
+                raise KeyError(f"{node.key} uses unknown pool {node.pool}")
+        # Kahn's algorithm, only used to detect cycles
+        indegree = {k: len(n.deps) for k, n in self.nodes.items()}
+        dependents = self._dependents()
+        ready = [k for k, d in indegree.items() if d == 0]
+        count = 0
+        while ready:
+            key = ready.pop()
+            count += 1
+            for k in dependents[key]:
+                indegree[k] -= 1
+                if indegree[k] == 0:
+                    ready.append(k)
+        if count != len(self.nodes):
+            raise ValueError("Dependency cycle in build graph")
+
+    def _dependents(self):
+        dependents = {k: [] for k in self.nodes}
+        for node in self.nodes.values():
+            for dep in node.deps:
+                dependents[dep].append(node.key)
+        return dependents
+
+    def priorities(self, durations: Dict[Hashable, float]):
+        """The total duration of the longest chain of nodes starting at each
+        node (including the node itself), given the durations of the nodes.
+        Starting the nodes with the highest priority first keeps the long
+        chains (and for independent nodes, the longest nodes) from being
+        started last and extending the total duration of the build."""
+        dependents = self._dependents()
+        result: Dict[Hashable, float] = {}
+
+        def visit(key):
+            if key not in result:
+                longest = max(map(visit, dependents[key]), default=0.0)
+                result[key] = durations.get(key, 0.0) + longest
+            return result[key]
+
+        for key in self.nodes:
+            visit(key)
+        return result
+
+    def simulate(self, durations: Dict[Hashable, float], jobs: int,
+                 tokens: Optional[int] = None,
+                 priorities: Optional[Dict[Hashable, float]] = None
+                 ) -> Dict[Hashable, Tuple[float, float]]:
+        """Predict the start and end time of each node if all nodes are run
+        the way run() does, given their durations."""
+        self.check()
+        if tokens is None:
+            tokens = jobs
+        waiting = {k: set(n.deps) for k, n in self.nodes.items()}
+        dependents = self._dependents()
+        ready: List[Hashable] = []
+        running: List[Tuple[float, int, Hashable]] = []  # heap by end time
+        times: Dict[Hashable, Tuple[float, float]] = {}
+        now = 0.0
+        available = _Tokens(self, tokens)
+
+        def make_ready(key):
+            del waiting[key]
+            ready.append(key)
+            if priorities is not None:
+                ready.sort(key=lambda k: -priorities.get(k, 0.0))
+
+        for key in [k for k, d in waiting.items() if not d]:
+            make_ready(key)
+        while True:
+            for key in list(ready):
+                if len(running) >= jobs:
+                    break
+                if available.fits(key):
+                    ready.remove(key)
+                    available.acquire(key)
+                    times[key] = now, now + durations.get(key, 0.0)
+                    heapq.heappush(running, (times[key][1], len(times), key))
+            if not running:
+                break
+            now, _, key = heapq.heappop(running)
+            available.release(key)
+            for k in dependents[key]:
+                deps = waiting[k]
+                deps.discard(key)
+                if not deps:
+                    make_ready(k)
+        return times
+
+    def run(self, jobs: int, tokens: Optional[int] = None,
+            keep_going: bool = False,
+            priorities: Optional[Dict[Hashable, float]] = None
+            ) -> Dict[Hashable, Optional[Exception]]:
+        """Run all nodes using at most ``jobs`` concurrent jobs. Each node
+        holds ``weight`` of the ``tokens`` while it runs, and as many of the
+        tokens of its pool, if any (nodes heavier than the total number of
+        tokens or than their pool are clamped to it). Of the nodes that are
+        ready, the ones with the highest ``priorities`` are started first
+        (otherwise in the order they were added). When a node fails, the
+        nodes that depend on it are skipped. Other nodes keep running if
+        ``keep_going`` is true, otherwise no new nodes are started (but the
+        running ones are allowed to finish). Returns the result of each node:
+        None if it succeeded, or the exception it raised (Skipped if it
+        didn't run)."""
+        self.check()
+        if tokens is None:
+            tokens = jobs
+        waiting = {k: set(n.deps) for k, n in self.nodes.items()}
+        dependents = self._dependents()
+        finished = queue.SimpleQueue()
+        ready: List[Hashable] = []
+        results: Dict[Hashable, Optional[Exception]] = {}
+        stopped = False
+        running = 0
+        available = _Tokens(self, tokens)
+
+        def skip(key, cause):
+            for k in dependents[key]:
+                if k in waiting:
+                    del waiting[k]
+                    results[k] = Skipped(f"{cause} failed")
+                    skip(k, cause)
+
+        with ThreadPool(jobs) as pool:
+
+            def submit(key):
+                pool.apply_async(
+                    self.nodes[key].func,
+                    callback=lambda _: finished.put((key, None)),
+                    error_callback=lambda e: finished.put((key, e)),
+                )
+
+            def make_ready(key):
+                del waiting[key]
+                ready.append(key)
+                if priorities is not None:
+                    ready.sort(key=lambda k: -priorities.get(k, 0.0))
+
+            for key in [k for k, d in waiting.items() if not d]:
+                make_ready(key)
+            while True:
+                # Start as many ready nodes as the job and token limits allow
+                for key in list(ready):
+                    if stopped or running >= jobs:
+                        break
+                    if available.fits(key):
+                        ready.remove(key)
+                        available.acquire(key)
+                        running += 1
+                        submit(key)
+                if not running:
+                    break
+                key, exc = finished.get()
+                running -= 1
+                available.release(key)
+                results[key] = exc
+                if exc is not None:
+                    skip(key, key)
+                    # Unless keep_going is set, don't start anything new, but
+                    # let running jobs finish
+                    stopped = stopped or not keep_going
+                    continue
+                for k in dependents[key]:
+                    if k not in waiting:  # Skipped
+                        continue
+                    deps = waiting[k]
+                    deps.discard(key)
+                    if not deps:
+                        make_ready(k)
+        for key in list(waiting) + ready:
+            results[key] = Skipped("the build was stopped")
+        return results
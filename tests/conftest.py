@@ -0,0 +1,28 @@
+from pathlib import Path
+import sys
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import package  # noqa: E402
+
+TRIPLE = "aarch64-rpi3-linux-gnu"
+
+HEADER = b"#pragma once\n" * 100
+
+
+@pytest.fixture
+def staging(tmp_path: Path, monkeypatch) -> Path:
+    """A staging directory with OpenBLAS and MUMPS, which both contain a copy
+    of the same header."""
+    monkeypatch.setattr(package, "this_dir", tmp_path)
+    root = tmp_path / "staging" / TRIPLE
+    for pkg, link in [("openblas-0.3.26", "openblas"),
+                      ("mumps-3.0.5", "mumps")]:
+        inc = root / pkg / "usr" / "local" / "include"
+        inc.mkdir(parents=True)
+        (inc / "common.h").write_bytes(HEADER)
+        (inc / f"{link}.h").write_text(f"// {link}\n")
+        (root / link).symlink_to(pkg)
+    return root
@@ -0,0 +1,190 @@
+import os
+from pathlib import Path
+import stat
+import sys
+from typing import List, Optional
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import build  # noqa: E402
+from artifact_cache import ArtifactCache, inputs_digest  # noqa: E402
+from build import BuildGraph, PlatformConfig, PythonVersion  # noqa: E402
+
+TRIPLE = "x86_64-centos7-linux-gnu"
+STAGING = f"staging/{TRIPLE}"
+
+# Values of the Makefile variables that run_target queries
+VARIABLES = {
+    "STAGING_DIR": STAGING,
+    "DOWNLOAD_DIR": "download",
+    "TOOLCHAIN": f"x-tools-{TRIPLE}.tar.xz",
+    "TOOLCHAIN_TXZ_URL": f"https://example.com/x-tools-{TRIPLE}.tar.xz",
+    "CMAKE_TOOLCHAIN": f"{STAGING}/{TRIPLE}.toolchain.cmake",
+    "ZLIB_STAGING_DIR": f"{STAGING}/zlib-1.3",
+    "ZLIB_INC": f"{STAGING}/zlib-1.3/usr/local/include/zlib.h",
+    "ZLIB_TGZ": "download/zlib-1.3.tar.gz",
+    "ZLIB_TGZ_URL": "https://example.com/zlib-1.3.tar.gz",
+    "PY_STAGING_DIR": f"{STAGING}/python3.11",
+    "PYTHON_BIN": f"{STAGING}/python3.11/usr/local/bin/python3",
+    "PYTHON_TGZ": "download/Python-3.11.10.tgz",
+    "PYTHON_TGZ_URL": "https://example.com/Python-3.11.10.tgz",
+}
+
+
+def test_inputs_digest():
+    inputs = ["zlib", TRIPLE, "recipe", "archive"]
+    assert inputs_digest(inputs) == inputs_digest(list(inputs))
+    assert inputs_digest(inputs) != inputs_digest(inputs[::-1])
+    # The inputs are length-prefixed, so their boundaries matter
+    assert inputs_digest(["ab", "c"]) != inputs_digest(["a", "bc"])
+    assert inputs_digest(["a", ""]) != inputs_digest(["a"])
+
+
+def test_store_restore(tmp_path: Path):
+    base = tmp_path / "staging"
+    pkg = base / "zlib-1.3" / "include"
+    pkg.mkdir(parents=True)
+    (pkg / "zlib.h").write_text("zlib\n")
+    (base / "zlib").symlink_to("zlib-1.3")
+    cache = ArtifactCache(tmp_path / "cache")
+    key = inputs_digest(["zlib"])
+    assert cache.lookup(key) is None
+    assert not cache.restore(key, base, ["zlib-1.3", "zlib"])
+
+    archive = cache.store(key, base, ["zlib-1.3", "zlib"])
+    assert cache.lookup(key) == archive
+    assert archive.parent.name == key[:2]
+    # Readable by other users of a shared cache
+    assert stat.S_IMODE(archive.stat().st_mode) == 0o666 & ~build_umask()
+    # Storing the same key again keeps the existing archive
+    assert cache.store(key, base, ["zlib-1.3"]) == archive
+
+    # Stale files are replaced by the cached ones
+    (pkg / "zlib.h").write_text("stale\n")
+    (pkg / "stale.h").write_text("stale\n")
+    (base / "zlib").unlink()
+    (base / "zlib").symlink_to("elsewhere")
+    assert cache.restore(key, base, ["zlib-1.3", "zlib"])
+    assert (pkg / "zlib.h").read_text() == "zlib\n"
+    assert not (pkg / "stale.h").exists()
+    assert os.readlink(base / "zlib") == "zlib-1.3"
+
+
+def build_umask() -> int:
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+class FakeBuilder:
+    """Answers run_target's queries from VARIABLES, and stages zlib when it
+    is run."""
+
+    workers = None
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.calls: List[Optional[List[str]]] = []
+
+    def query(self, py, platform, variables: List[str]) -> List[str]:
+        return [VARIABLES.get(v, "") for v in variables]
+
+    def __call__(self, args, assume_old: Optional[List[str]] = None):
+        self.calls.append(assume_old)
+        inc = self.root / VARIABLES["ZLIB_INC"]
+        inc.parent.mkdir(parents=True, exist_ok=True)
+        inc.write_text("zlib\n")
+        link = self.root / STAGING / "zlib"
+        if not link.is_symlink():
+            link.symlink_to("zlib-1.3")
+
+
+@pytest.fixture
+def graph(tmp_path: Path, monkeypatch):
+    """A build graph with zlib and Python for one triple, using a cache in
+    a temporary directory, with the archives of the toolchain and zlib."""
+
+    def make_graph():
+        g = BuildGraph(TRIPLE, 1, 1, {}, ArtifactCache(tmp_path / "cache"))
+        g.add(toolchain, None, [])
+        g.add(zlib, None, [toolchain])
+        g.add(python, None, [zlib])
+        return g
+
+    toolchain, zlib = ("toolchain", TRIPLE, None), ("zlib", TRIPLE, None)
+    python = ("python", TRIPLE, "3.11.10")
+    # The sections of the Makefile are read from the repository
+    sections = build.makefile_sections()
+    monkeypatch.setattr(build, "makefile_sections", lambda: sections)
+    monkeypatch.setattr(build, "this_dir", tmp_path)
+    g = make_graph()
+    for var in ["TOOLCHAIN", "ZLIB_TGZ", "PYTHON_TGZ"]:
+        path = tmp_path / VARIABLES[var]
+        if var == "TOOLCHAIN":
+            path = tmp_path / "download" / path.name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(var)
+    (tmp_path / STAGING).mkdir(parents=True)
+    return g, make_graph
+
+
+def run_target(g: BuildGraph, builder: FakeBuilder, key: tuple):
+    py = PythonVersion(3, 11, 10)
+    platform = PlatformConfig.from_string(TRIPLE)
+    g.targets[key] = builder, py, platform
+    g.run_target(key, builder, py, platform)
+
+
+def test_cache_hit(tmp_path: Path, graph):
+    g, make_graph = graph
+    zlib = ("zlib", TRIPLE, None)
+    builder = FakeBuilder(tmp_path)
+    run_target(g, builder, zlib)
+    assert builder.calls == [[]]
+    key = g.cache_keys[zlib]
+    assert g.cache.lookup(key) is not None
+    assert g.markers[zlib] == VARIABLES["ZLIB_INC"]
+
+    # A new build restores zlib from the cache instead of building it
+    staged = tmp_path / VARIABLES["ZLIB_STAGING_DIR"]
+    (tmp_path / STAGING / "zlib").unlink()
+    for p in sorted(staged.rglob("*"), reverse=True):
+        p.unlink() if p.is_file() else p.rmdir()
+    g = make_graph()
+    builder = FakeBuilder(tmp_path)
+    run_target(g, builder, zlib)
+    assert builder.calls == []
+    assert g.cache_keys[zlib] == key
+    assert (tmp_path / VARIABLES["ZLIB_INC"]).read_text() == "zlib\n"
+    assert os.readlink(tmp_path / STAGING / "zlib") == "zlib-1.3"
+
+    # Another source archive gives another key
+    (tmp_path / VARIABLES["ZLIB_TGZ"]).write_text("zlib 1.3.1")
+    g = make_graph()
+    run_target(g, builder, zlib)
+    assert builder.calls == [[]]
+    assert g.cache_keys[zlib] != key
+
+
+def test_unidentified_archive_is_not_cached(tmp_path: Path, graph):
+    g, _ = graph
+    zlib = ("zlib", TRIPLE, None)
+    (tmp_path / VARIABLES["ZLIB_TGZ"]).unlink()
+    builder = FakeBuilder(tmp_path)
+    run_target(g, builder, zlib)
+    assert builder.calls == [[]]
+    assert zlib not in g.cache_keys
+    assert not (tmp_path / "cache").exists()
+
+
+def test_uncached_dependency_is_not_cached(tmp_path: Path, graph):
+    g, _ = graph
+    python = ("python", TRIPLE, "3.11.10")
+    # zlib was built without being cached, so Python can't be identified
+    builder = FakeBuilder(tmp_path)
+    run_target(g, builder, python)
+    assert builder.calls == [[]]
+    assert python not in g.cache_keys
+    assert not (tmp_path / "cache").exists()
@@ -0,0 +1,128 @@
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+import sys
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from download import (UNPINNED, UNVERIFIABLE, ChecksumError,  # noqa: E402
+                      Download, Downloader, read_checksums, sha256,
+                      write_checksums)
+
+URL = "https://example.com/archives"
+
+
+@pytest.fixture
+def mirror(tmp_path: Path) -> Path:
+    mirror = tmp_path / "mirror"
+    mirror.mkdir()
+    for name in ["zlib-1.3.tar.gz", "fftw-3.3.10.tar.gz",
+                 "x-tools-aarch64-rpi3-linux-gnu-gcc13.tar.xz"]:
+        (mirror / name).write_bytes(name.encode() * 100)
+    return mirror
+
+
+def download(tmp_path: Path, name: str) -> Download:
+    return Download(tmp_path / "download" / name, f"{URL}/{name}")
+
+
+def test_verified_download(tmp_path: Path, mirror: Path):
+    name = "zlib-1.3.tar.gz"
+    checksums = {name: sha256(mirror / name)}
+    dl = download(tmp_path, name)
+    Downloader(checksums, mirror)(dl)
+    assert dl.path.read_bytes() == (mirror / name).read_bytes()
+    assert not dl.path.with_name(name + ".part").exists()
+
+
+def test_checksum_mismatch(tmp_path: Path, mirror: Path):
+    name = "zlib-1.3.tar.gz"
+    checksums = {name: sha256(mirror / name)}
+    dl = download(tmp_path, name)
+    dl.path.parent.mkdir()
+    dl.path.write_bytes(b"truncated")
+    # The corrupt file is fetched again
+    Downloader(checksums, mirror)(dl)
+    assert sha256(dl.path) == checksums[name]
+    # A file that doesn't match after fetching it is refused
+    (mirror / name).write_bytes(b"tampered")
+    dl.path.unlink()
+    with pytest.raises(ChecksumError, match="mismatch"):
+        Downloader(checksums, mirror)(dl)
+    assert not dl.path.exists()
+    assert not dl.path.with_name(name + ".part").exists()
+
+
+def test_unlisted_archive_is_refused(tmp_path: Path, mirror: Path):
+    dl = download(tmp_path, "fftw-3.3.10.tar.gz")
+    downloader = Downloader({}, mirror)
+    with pytest.raises(ChecksumError, match="No checksum"):
+        downloader(dl)
+    assert not dl.path.exists()
+    assert downloader.run([dl], 2) == [dl]
+
+
+def test_other_url_is_refused(tmp_path: Path, mirror: Path):
+    name = "zlib-1.3.tar.gz"
+    checksums = {name: sha256(mirror / name)}
+    urls = {name: f"https://example.org/{name}"}
+    with pytest.raises(ChecksumError, match="URL"):
+        Downloader(checksums, mirror, urls=urls)(download(tmp_path, name))
+
+
+def test_unverifiable_pattern(tmp_path: Path, mirror: Path):
+    checksums = {"x-tools-*-gcc13.tar.xz": UNVERIFIABLE}
+    name = "x-tools-aarch64-rpi3-linux-gnu-gcc13.tar.xz"
+    dl = download(tmp_path, name)
+    downloader = Downloader(checksums, mirror)
+    downloader(dl)
+    assert dl.path.exists()
+    assert not downloader.recorded
+    with pytest.raises(ChecksumError):
+        downloader(download(tmp_path, "x-tools-aarch64-rpi3-linux-gnu.tar.xz"))
+
+
+def test_unpinned_checksum_is_recorded(tmp_path: Path, mirror: Path):
+    name = "fftw-3.3.10.tar.gz"
+    checksums = {name: UNPINNED}
+    downloader = Downloader(checksums, mirror)
+    downloader(download(tmp_path, name))
+    assert checksums[name] == sha256(mirror / name)
+    assert downloader.recorded == {name: f"{URL}/{name}"}
+
+
+def test_update_checksums(tmp_path: Path, mirror: Path):
+    manifest = tmp_path / "checksums.sha256"
+    manifest.write_text("# Header\n"
+                        "unverifiable  x-tools-*-gcc13.tar.xz\n")
+    urls = {}
+    checksums = read_checksums(manifest, urls)
+    downloader = Downloader(checksums, mirror, record=True, urls=urls)
+    downloads = [download(tmp_path, n) for n in sorted(p.name for p in
+                                                       mirror.iterdir())]
+    assert downloader.run(downloads, 3) == []
+    write_checksums(manifest, checksums, downloader.recorded)
+    fftw, zlib = "fftw-3.3.10.tar.gz", "zlib-1.3.tar.gz"
+    assert manifest.read_text().splitlines() == [
+        "# Header",
+        "unverifiable  x-tools-*-gcc13.tar.xz",
+        f"{sha256(mirror / fftw)}  {fftw}  {URL}/{fftw}",
+        f"{sha256(mirror / zlib)}  {zlib}  {URL}/{zlib}",
+    ]
+    urls = {}
+    assert read_checksums(manifest, urls) == checksums
+    assert urls == {fftw: f"{URL}/{fftw}", zlib: f"{URL}/{zlib}"}
+
+
+def test_concurrent_downloads_of_same_file(tmp_path: Path, mirror: Path):
+    name = "zlib-1.3.tar.gz"
+    (mirror / name).write_bytes(b"zlib" * (1 << 20))
+    checksums = {name: sha256(mirror / name)}
+    downloader = Downloader(checksums, mirror)
+    # E.g. the deferred downloads of the zlib jobs of several triples
+    dls = [download(tmp_path, name) for _ in range(8)]
+    with ThreadPool(8) as pool:
+        pool.map(downloader, dls)
+    assert sha256(dls[0].path) == checksums[name]
+    assert not dls[0].path.with_name(name + ".part").exists()
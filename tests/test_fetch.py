@@ -0,0 +1,47 @@
+import json
+from pathlib import Path
+import shutil
+import sys
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from conftest import TRIPLE  # noqa: E402
+import fetch  # noqa: E402
+import package  # noqa: E402
+from package import index_name  # noqa: E402
+
+
+@pytest.mark.skipif(not shutil.which("zstd"), reason="zstd is not installed")
+def test_fetch_resolve(tmp_path: Path, staging: Path):
+    components = tmp_path / "components"
+    package.package_components(TRIPLE, components, [], dedup=True, level=1,
+                               jobs=2)
+    index = fetch.load_index(str(components), TRIPLE)
+    assert (components / index_name(TRIPLE)).exists()
+    assert set(index["components"]) == {"openblas", "mumps"}
+    assert index["components"]["mumps"]["depends"] == ["openblas"]
+    assert fetch.resolve(index, ["openblas"]) == ["openblas"]
+    assert fetch.resolve(index, ["mumps"]) == ["openblas", "mumps"]
+    with pytest.raises(KeyError):
+        fetch.resolve(index, ["ipopt"])
+
+    # Fetch only OpenBLAS from the local index
+    dest = tmp_path / "dest"
+    fetcher = fetch.Fetcher(str(components), dest, tmp_path / "cache")
+    assert fetcher(TRIPLE, ["openblas"])
+    archive = index["components"]["openblas"]["archive"]
+    assert archive == f"openblas-{TRIPLE}.tar.zst"
+    assert [p.name for p in (tmp_path / "cache").iterdir()] == [archive]
+    root = dest / TRIPLE
+    assert (root / "openblas" / "usr/local/include/openblas.h").exists()
+    assert not (root / "mumps").exists()
+    installed = json.loads(fetcher.state_file(TRIPLE).read_text())
+    assert installed == {"openblas": index["components"]["openblas"]["sha256"]}
+
+    # MUMPS pulls in OpenBLAS, which is already up to date
+    assert fetcher(TRIPLE, ["mumps"])
+    assert (root / "mumps" / "usr/local/include/mumps.h").read_text() == \
+        "// mumps\n"
+    assert set(fetcher.installed(TRIPLE)) == {"openblas", "mumps"}
@@ -0,0 +1,63 @@
+import os
+from pathlib import Path
+import shutil
+import sys
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from build import MakefileBuilder, PythonVersion  # noqa: E402
+from gen_configs import config_files, generate  # noqa: E402
+from platform_config import PlatformConfig  # noqa: E402
+
+TRIPLE = "aarch64-rpi3-linux-gnu"
+
+
+def test_unchanged_configs_are_kept(tmp_path: Path):
+    staging, build = tmp_path / "staging", tmp_path / "build"
+    generate([TRIPLE], staging, build)
+    configs = sorted((staging / TRIPLE).iterdir())
+    assert f"{TRIPLE}.toolchain.cmake" in [p.name for p in configs]
+    stamp = build / TRIPLE / "configs.stamp"
+    # Pretend that everything was generated (and built) a while ago
+    for path in configs + [stamp]:
+        os.utime(path, (1e9, 1e9))
+    toolchain = staging / TRIPLE / f"{TRIPLE}.toolchain.cmake"
+    toolchain.write_text("# Outdated\n")
+    os.utime(toolchain, (1e9, 1e9))
+
+    generate([TRIPLE], staging, build)
+    # Only the config that changed is written again
+    assert toolchain.read_text() != "# Outdated\n"
+    assert toolchain.stat().st_mtime > 1e9
+    for path in configs:
+        if path != toolchain:
+            assert path.stat().st_mtime == 1e9, path
+    assert not any(p.suffix == ".tmp" for p in (staging / TRIPLE).iterdir())
+    # The stamp is touched, so make knows the configs are up to date
+    assert stamp.stat().st_mtime > 1e9
+
+
+@pytest.mark.skipif(not shutil.which("make"), reason="make is not installed")
+def test_free_threaded_configs():
+    py = PythonVersion(3, 13, 0, executable="python3", flavour="freethreaded")
+    cfg = PlatformConfig.from_string(TRIPLE)
+    configs = config_files(cfg)
+    cross = configs[f"{TRIPLE}.py-build-cmake.cross.cp313t.toml"]
+    assert "abi = 'cp313t'" in cross
+    assert "version = '313'" in cross
+    assert "TOOLCHAIN_PYTHON_ABIFLAGS = 't'" in cross
+    assert f"include({TRIPLE}.conan.profile)" in \
+        configs[f"{TRIPLE}.freethreaded.conan.profile"]
+    # The toolchain file looks for the free-threaded build in python3.13t
+    toolchain = configs[f"{TRIPLE}.toolchain.cmake"]
+    assert 'string(APPEND python_dir "t")' in toolchain
+    assert "set(TOOLCHAIN_${prefix}_FREE_THREADED TRUE)" in toolchain
+    # which is where the Makefile stages it
+    builder = MakefileBuilder("x86_64-centos7-linux-gnu", ["python"])
+    staging_dir, link_sfx, python_bin = builder.query(
+        py, cfg, ["PY_STAGING_DIR", "PY_LINK_SFX", "PYTHON_BIN"])
+    assert staging_dir == f"staging/{TRIPLE}/Python-3.13.0-freethreaded"
+    assert f"python{py.major}.{py.minor}{link_sfx}" == "python3.13t"
+    assert python_bin == f"{staging_dir}/usr/local/bin/python3.13t"
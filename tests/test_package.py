@@ -0,0 +1,43 @@
+from pathlib import Path
+import sys
+import tarfile
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from conftest import HEADER, TRIPLE  # noqa: E402
+import package  # noqa: E402
+from package import MANIFEST_NAME  # noqa: E402
+
+
+def test_dedup_manifest(tmp_path: Path, staging: Path):
+    output = tmp_path / f"full-{TRIPLE}.tar.xz"
+    package.package(TRIPLE, output, package.top_level(staging, []),
+                    dedup=True, level=1, jobs=2)
+    with tarfile.open(output) as tar:
+        members = {m.name: m for m in tar.getmembers()}
+        manifest = tar.extractfile(f"{TRIPLE}/{MANIFEST_NAME}").read()
+    inc = "usr/local/include/common.h"
+    first = f"{TRIPLE}/mumps-3.0.5/{inc}"
+    second = f"{TRIPLE}/openblas-0.3.26/{inc}"
+    # The contents of the duplicate header are only stored once
+    assert members[first].isreg() and members[first].size == len(HEADER)
+    assert members[second].islnk() and members[second].linkname == first
+    assert members[f"{TRIPLE}/openblas"].issym()
+    # Every file is listed in the manifest exactly once
+    lines = manifest.decode().splitlines()
+    files = [line.split(maxsplit=1)[1] for line in lines]
+    assert sorted(files) == sorted(set(files))
+    assert sorted(files) == [f"mumps-3.0.5/{inc}",
+                             "mumps-3.0.5/usr/local/include/mumps.h",
+                             f"openblas-0.3.26/{inc}",
+                             "openblas-0.3.26/usr/local/include/openblas.h"]
+    digests = dict(reversed(line.split(maxsplit=1)) for line in lines)
+    assert digests[f"mumps-3.0.5/{inc}"] == digests[f"openblas-0.3.26/{inc}"]
+
+
+def test_no_dedup(tmp_path: Path, staging: Path):
+    output = tmp_path / f"full-{TRIPLE}.tar.xz"
+    package.package(TRIPLE, output, package.top_level(staging, []),
+                    dedup=False, level=1, jobs=2)
+    with tarfile.open(output) as tar:
+        assert not any(m.islnk() for m in tar.getmembers())
@@ -0,0 +1,72 @@
+from pathlib import Path
+import sys
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import platform_config  # noqa: E402
+from platform_config import (PLATFORMS_FILE_ENV, PlatformConfig,  # noqa: E402
+                             arch_flags, conan_arch, known_platforms, openblas_target,
+                             python_arch, toolchain_triple)
+
+
+@pytest.fixture
+def platforms_file(tmp_path: Path, monkeypatch):
+    """Points CROSS_PYTHON_PLATFORMS to a file in a temporary directory, and
+    makes platform_table read it again."""
+    path = tmp_path / "platforms.toml"
+    monkeypatch.setenv(PLATFORMS_FILE_ENV, str(path))
+    platform_config.platform_table.cache_clear()
+    yield path
+    platform_config.platform_table.cache_clear()
+
+
+@pytest.mark.parametrize("triple, toolchain", [
+    ("x86_64-centos7-linux-gnu", "x86_64-centos7-linux-gnu"),
+    ("x86_64-v3-linux-gnu", "x86_64-centos7-linux-gnu"),
+    ("x86_64-v4-linux-gnu", "x86_64-centos7-linux-gnu"),
+    ("aarch64-rpi3-linux-gnu", "aarch64-rpi3-linux-gnu"),
+    ("aarch64-rpi4-linux-gnu", "aarch64-rpi3-linux-gnu"),
+    ("aarch64-rpi5-linux-gnu", "aarch64-rpi3-linux-gnu"),
+])
+def test_toolchain_triple(triple: str, toolchain: str):
+    assert toolchain_triple(PlatformConfig.from_string(triple)) == toolchain
+
+
+def test_platforms_file(platforms_file: Path):
+    platforms_file.write_text("""\
+[cpus.riscv64]
+debian_arch = "riscv64"
+conan_arch = "riscv64gc"
+
+[platforms.riscv64-jh7110-linux-gnu]
+arch_flags = "-march=rv64gc"
+python_platform = "manylinux_2_31"
+
+[platforms.aarch64-rpi4-linux-gnu]
+openblas_target = "CORTEXA57"
+""")
+    riscv = PlatformConfig.from_string("riscv64-jh7110-linux-gnu")
+    assert "riscv64-jh7110-linux-gnu" in known_platforms()
+    assert toolchain_triple(riscv) == str(riscv)
+    assert arch_flags(riscv) == "-march=rv64gc"
+    assert python_arch(riscv) == "manylinux_2_31_riscv64"
+    assert conan_arch(riscv) == "riscv64gc"
+    # Only the given properties of existing platforms are overridden
+    rpi4 = PlatformConfig.from_string("aarch64-rpi4-linux-gnu")
+    assert openblas_target(rpi4) == "CORTEXA57"
+    assert toolchain_triple(rpi4) == "aarch64-rpi3-linux-gnu"
+    assert arch_flags(rpi4) == "-mcpu=cortex-a72"
+    # The built-in tables are left alone
+    assert platform_config.PLATFORMS["aarch64-rpi4-linux-gnu"][
+        "openblas_target"] == "CORTEXA72"
+
+
+def test_invalid_platforms_file(platforms_file: Path):
+    platforms_file.write_text("""\
+[platforms.aarch64-rpi3-linux-gnu]
+no_such_property = 1
+""")
+    with pytest.raises(ValueError, match="aarch64-rpi3-linux-gnu"):
+        arch_flags(PlatformConfig.from_string("aarch64-rpi3-linux-gnu"))
@@ -0,0 +1,147 @@
+from io import BytesIO
+from pathlib import Path
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import remote  # noqa: E402
+from download import CHECKSUMS_FILE, Download, sha256  # noqa: E402
+from remote import Worker, WorkerPool, WorkerServer, check_job  # noqa: E402
+
+TRIPLE = "x86_64-centos7-linux-gnu"
+ARCHIVE = "pkg-1.0.tar.gz"
+URL = f"https://example.com/{ARCHIVE}"
+
+# Stands in for the repository's Makefile on the workers
+MAKEFILE = """\
+pkg:
+\t@echo "Building pkg for $(HOST_TRIPLE)"
+\tmkdir -p staging/$(HOST_TRIPLE)/pkg-1.0
+\techo $(HOST_TRIPLE) > staging/$(HOST_TRIPLE)/pkg-1.0/file.txt
+\tln -sfn pkg-1.0 staging/$(HOST_TRIPLE)/pkg
+
+fail:
+\t@echo "Failing for $(HOST_TRIPLE)"
+\tfalse
+"""
+
+
+def job(**kwargs) -> dict:
+    msg = {"type": "job", "name": "pkg " + TRIPLE, "targets": ["pkg"],
+           "options": [f"HOST_TRIPLE={TRIPLE}"], "jobs": 1,
+           "outputs": [f"staging/{TRIPLE}/pkg-1.0"], "assume_old": []}
+    msg.update(kwargs)
+    return msg
+
+
+@pytest.fixture
+def workers(tmp_path: Path, monkeypatch):
+    """Two workers on localhost, each with its own checkout, and a
+    coordinator directory that the results are extracted to."""
+    coordinator = tmp_path / "coordinator"
+    coordinator.mkdir()
+    monkeypatch.setattr(remote, "this_dir", coordinator)
+    mirror = tmp_path / "mirror"
+    mirror.mkdir()
+    (mirror / ARCHIVE).write_bytes(b"sources")
+    (mirror / "unlisted.tar.gz").write_bytes(b"sources")
+    servers = []
+    for i in range(2):
+        repo = tmp_path / f"worker{i}"
+        repo.mkdir()
+        (repo / "Makefile").write_text(MAKEFILE)
+        (repo / CHECKSUMS_FILE).write_text(
+            f"{sha256(mirror / ARCHIVE)}  {ARCHIVE}  {URL}\n")
+        server = WorkerServer(("127.0.0.1", 0), Worker(repo, mirror))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    addresses = ["127.0.0.1:{}".format(s.server_address[1]) for s in servers]
+    yield WorkerPool(addresses), coordinator
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_triple_affinity(workers):
+    pool, _ = workers
+    first = pool.worker_for(TRIPLE)
+    second = pool.worker_for("aarch64-rpi3-linux-gnu")
+    assert first is not second
+    assert pool.worker_for(TRIPLE) is first
+    assert first.triples == [TRIPLE]
+
+
+def test_run_job(workers):
+    pool, coordinator = workers
+    log = BytesIO()
+    record = pool.run("pkg " + TRIPLE, TRIPLE, ["pkg"],
+                      [f"HOST_TRIPLE={TRIPLE}"], 1,
+                      [f"staging/{TRIPLE}/pkg-1.0"], [], log)
+    assert record.status == 0
+    assert f"Building pkg for {TRIPLE}".encode() in log.getvalue()
+    staged = coordinator / "staging" / TRIPLE
+    assert (staged / "pkg-1.0" / "file.txt").read_text() == TRIPLE + "\n"
+    # Links to the output are returned as well
+    assert (staged / "pkg").is_symlink()
+
+
+def test_run_failed_job(workers):
+    pool, coordinator = workers
+    log = BytesIO()
+    record = pool.run("fail " + TRIPLE, TRIPLE, ["fail"],
+                      [f"HOST_TRIPLE={TRIPLE}"], 1,
+                      [f"staging/{TRIPLE}/pkg-1.0"], [], log)
+    assert record.status != 0
+    assert f"Failing for {TRIPLE}".encode() in log.getvalue()
+    assert not (coordinator / "staging").exists()
+
+
+def test_sources_are_verified(workers, tmp_path: Path):
+    pool, coordinator = workers
+    worker = pool.worker_for(TRIPLE)
+    repo = tmp_path / f"worker{pool.workers.index(worker)}"
+    dl = Download(coordinator / "download" / ARCHIVE, URL)
+    record = pool.run("pkg " + TRIPLE, TRIPLE, ["pkg"],
+                      [f"HOST_TRIPLE={TRIPLE}"], 1, [], [], None, [dl])
+    assert record.status == 0
+    assert (repo / "download" / ARCHIVE).read_bytes() == b"sources"
+    # Archives without a checksum are refused, like by the coordinator
+    dl = Download(coordinator / "download" / "unlisted.tar.gz",
+                  "https://example.com/unlisted.tar.gz")
+    with pytest.raises(RuntimeError, match="unlisted.tar.gz"):
+        pool.run("pkg " + TRIPLE, TRIPLE, ["pkg"], [f"HOST_TRIPLE={TRIPLE}"],
+                 1, [], [], None, [dl])
+    assert not (repo / "download" / "unlisted.tar.gz").exists()
+
+
+def test_invalid_job_is_refused(workers):
+    pool, _ = workers
+    with pytest.raises(RuntimeError, match="Invalid option"):
+        pool.worker_for(TRIPLE).run(job(options=["SHELL=/bin/sh"]), None)
+
+
+@pytest.mark.parametrize("msg", [
+    job(options=["SHELL=/bin/sh"]),
+    job(options=["HOST_TRIPLE=$(shell rm -rf /)"]),
+    job(targets=["--eval=x"]),
+    job(targets=["pkg;ls"]),
+    job(assume_old=["../Makefile"]),
+    job(assume_old=["/etc/passwd"]),
+    job(outputs=["staging/../../.ssh"]),
+    job(outputs=["/etc"]),
+    job(outputs=["build/x"]),
+    job(downloads=[("../x.tar.gz", URL)]),
+    job(downloads=[("/tmp/x.tar.gz", URL)]),
+    job(downloads=[(f"download/{ARCHIVE}", "file:///etc/passwd")]),
+])
+def test_check_job(msg: dict):
+    with pytest.raises(ValueError):
+        check_job(msg)
+
+
+def test_check_job_valid():
+    check_job(job(assume_old=[f"staging/{TRIPLE}/x-tools/bin"],
+                  downloads=[(f"download/{ARCHIVE}", URL)]))
@@ -0,0 +1,173 @@
+from pathlib import Path
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from scheduler import Scheduler, Skipped  # noqa: E402
+from timing import DurationDB  # noqa: E402
+
+
+class FakeJobs:
+    """Jobs that record the order in which they start, and the number of
+    tokens in use while they run."""
+
+    def __init__(self, weights: Optional[Dict[str, int]] = None):
+        self.weights = weights or {}
+        self.lock = threading.Lock()
+        self.started: List[str] = []
+        self.in_use = 0
+        self.max_in_use = 0
+
+    def __call__(self, key: str, duration: float = 0.0, fail: bool = False):
+
+        def job():
+            weight = self.weights.get(key, 1)
+            with self.lock:
+                self.started.append(key)
+                self.in_use += weight
+                self.max_in_use = max(self.max_in_use, self.in_use)
+            time.sleep(duration)
+            with self.lock:
+                self.in_use -= weight
+            if fail:
+                raise RuntimeError(f"{key} failed")
+
+        return job
+
+
+def test_dependents_of_failure_are_skipped():
+    jobs, s = FakeJobs(), Scheduler()
+    s.add("toolchain", jobs("toolchain", fail=True), [])
+    s.add("zlib", jobs("zlib"), ["toolchain"])
+    s.add("python", jobs("python"), ["zlib"])
+    s.add("cmake", jobs("cmake"), [])
+    results = s.run(2, keep_going=True)
+    assert isinstance(results["toolchain"], RuntimeError)
+    assert isinstance(results["zlib"], Skipped)
+    assert isinstance(results["python"], Skipped)
+    assert results["cmake"] is None
+    assert "zlib" not in jobs.started and "python" not in jobs.started
+
+
+def test_stop_after_failure():
+    jobs, s = FakeJobs(), Scheduler()
+    s.add("a", jobs("a", 0.2), [])
+    s.add("b", jobs("b", fail=True), [])
+    s.add("c", jobs("c"), ["a"])
+    results = s.run(2)
+    # The running job is allowed to finish, but nothing new is started
+    assert results["a"] is None
+    assert isinstance(results["b"], RuntimeError)
+    assert isinstance(results["c"], Skipped)
+    assert "c" not in jobs.started
+
+
+def test_keep_going_after_failure():
+    jobs, s = FakeJobs(), Scheduler()
+    s.add("a", jobs("a", 0.2), [])
+    s.add("b", jobs("b", fail=True), [])
+    s.add("c", jobs("c"), ["a"])
+    results = s.run(2, keep_going=True)
+    assert results["a"] is None and results["c"] is None
+    assert isinstance(results["b"], RuntimeError)
+
+
+@pytest.mark.parametrize("tokens", [2, 4, 5])
+def test_token_limit(tokens: int):
+    weights = {f"j{i}": w for i, w in enumerate([3, 1, 2, 4, 1, 2, 8, 1])}
+    # Jobs heavier than the limit are clamped to it
+    jobs = FakeJobs({k: min(w, tokens) for k, w in weights.items()})
+    s = Scheduler()
+    for key, weight in weights.items():
+        s.add(key, jobs(key, 0.02), [], weight)
+    results = s.run(len(weights), tokens)
+    assert all(e is None for e in results.values())
+    assert sorted(jobs.started) == sorted(weights)
+    assert 1 < jobs.max_in_use <= tokens
+
+
+def test_pool_limit():
+    jobs, s = FakeJobs(), Scheduler()
+    s.add_pool("worker", 1)
+    for key in "abc":
+        s.add(key, jobs(key, 0.02), [], 1, "worker")
+    s.run(3, 3)
+    assert jobs.max_in_use == 1
+
+
+def test_plan_follows_critical_path():
+    durations = {"toolchain": 1.0, "python": 5.0, "cmake": 1.0,
+                 "openblas": 3.0, "mumps": 4.0, "eigen": 2.0}
+    deps = {"toolchain": [], "python": ["toolchain"], "cmake": [],
+            "openblas": ["cmake"], "mumps": ["openblas"], "eigen": []}
+    jobs, s = FakeJobs(), Scheduler()
+    for key, d in deps.items():
+        s.add(key, jobs(key), d)
+    priorities = s.priorities(durations)
+    assert priorities["cmake"] == 8.0 and priorities["toolchain"] == 6.0
+    times = s.simulate(durations, 1, priorities=priorities)
+    # Of the ready jobs, the one with the longest remaining chain goes first
+    order = sorted(times, key=lambda k: times[k][0])
+    assert order == ["cmake", "openblas", "toolchain", "python", "mumps",
+                     "eigen"]
+    assert max(end for _, end in times.values()) == sum(durations.values())
+    # Running the graph starts the jobs in the simulated order
+    s.run(1, priorities=priorities)
+    assert jobs.started == order
+
+
+def test_priorities_longest_chain_first():
+    durations = {"a": 1.0, "b": 1.0, "c": 1.0, "d": 2.5, "e": 3.0}
+    s = Scheduler()
+    # a -> b -> c is the longest chain, even though d and e take longer
+    s.add("a", None, [])
+    s.add("b", None, ["a"])
+    s.add("c", None, ["b"])
+    s.add("d", None, [])
+    s.add("e", None, ["d"])
+    s.add("f", None, ["a", "d"])
+    priorities = s.priorities(durations)
+    assert priorities == {"a": 3.0, "b": 2.0, "c": 1.0, "d": 5.5, "e": 3.0,
+                          "f": 0.0}
+    times = s.simulate(durations, 1, priorities=priorities)
+    assert sorted(times, key=lambda k: times[k][0]) == \
+        ["d", "a", "e", "b", "c", "f"]
+
+
+def test_duration_estimate(tmp_path: Path):
+    db = DurationDB(tmp_path / "durations.json")
+    assert db.estimate("python aarch64-rpi3-linux-gnu 3.11.10") is None
+    db.durations = {
+        "python aarch64-rpi3-linux-gnu 3.11.10": 300.0,
+        "python x86_64-centos7-linux-gnu 3.12.7": 200.0,
+        "zlib aarch64-rpi3-linux-gnu": 10.0,
+    }
+    db.save()
+    db = DurationDB(tmp_path / "durations.json")
+    # The previous duration of the same job
+    assert db.estimate("python aarch64-rpi3-linux-gnu 3.11.10") == 300.0
+    # The mean of the same target for other triples and versions
+    assert db.estimate("python armv6-rpi-linux-gnueabihf 3.13.0") == 250.0
+    assert db.estimate("zlib x86_64-centos7-linux-gnu") == 10.0
+    # Nothing similar
+    assert db.estimate("mumps aarch64-rpi3-linux-gnu") is None
+
+
+def test_plan_with_parallel_jobs():
+    durations = {"a": 4.0, "b": 1.0, "c": 1.0, "d": 2.0}
+    s = Scheduler()
+    s.add("a", None, [])
+    s.add("b", None, [])
+    s.add("c", None, ["b"])
+    s.add("d", None, [], 2)
+    times = s.simulate(durations, 2, 2, s.priorities(durations))
+    assert times["a"] == (0.0, 4.0)
+    assert times["b"] == (0.0, 1.0)
+    assert times["c"] == (1.0, 2.0)
+    # d needs both tokens, so it waits for a to finish
+    assert times["d"] == (4.0, 6.0)
@@ -0,0 +1,44 @@
+from pathlib import Path
+import re
+from subprocess import DEVNULL
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from timing import run_timed  # noqa: E402
+
+MAKEFILE = Path(__file__).resolve().parent.parent / "Makefile"
+
+
+def stage_macro() -> str:
+    """The definition of the stage macro in the Makefile."""
+    text = MAKEFILE.read_text()
+    m = re.search(r"^BUILD_TRACE :=\n(?:.*\\\n)*.*\n", text, re.MULTILINE)
+    assert m, "stage macro not found in the Makefile"
+    return m.group(0)
+
+
+def test_failed_stage_status(tmp_path: Path):
+    (tmp_path / "Makefile").write_text(
+        "SHELL := bash\n" + stage_macro() +
+        "t:\n\t$(call stage,download) false\n")
+    trace = tmp_path / "trace.txt"
+    record = run_timed("t", ["make", "-s", "-C", str(tmp_path),
+                             f"BUILD_TRACE={trace}"], stages=trace,
+                       stdout=DEVNULL)
+    assert record.status != 0
+    assert [s.name for s in record.stages] == ["download"]
+    assert record.stages[0].status != 0
+
+
+def test_successful_stage_status(tmp_path: Path):
+    (tmp_path / "Makefile").write_text(
+        "SHELL := bash\n" + stage_macro() +
+        "t:\n\t$(call stage,extract) true && $(call stage,build) true\n")
+    trace = tmp_path / "trace.txt"
+    record = run_timed("t", ["make", "-s", "-C", str(tmp_path),
+                             f"BUILD_TRACE={trace}"], stages=trace,
+                       stdout=DEVNULL)
+    assert record.status == 0
+    assert [(s.name, s.status) for s in record.stages] == \
+        [("extract", 0), ("build", 0)]
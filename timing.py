@@ -0,0 +1,267 @@
+import dataclasses
+import json
+import os
+from pathlib import Path
+from subprocess import PIPE, STDOUT, Popen
+import threading
+import time
+from typing import Callable, Dict, Hashable, Iterable, List, Optional
+
+from ccache import read_stats_log
+
+
+@dataclasses.dataclass
+class Stage:
+    name: str  # download, extract, configure, build or install
+    target: str  # Makefile target whose recipe the stage belongs to
+    start: float
+    end: float
+    status: int = 0  # Exit status of the recipe line, if the stage ended it
+
+
+@dataclasses.dataclass
+class JobRecord:
+    name: str
+    start: float
+    end: float
+    user: float = 0.0  # CPU time of the job and all its children (seconds)
+    sys: float = 0.0
+    maxrss: int = 0  # Peak RSS of the largest process of the job (KiB)
+    status: int = 0
+    stages: List[Stage] = dataclasses.field(default_factory=list)
+    # Compilations of the job that were (not) found in the ccache cache
+    ccache_hits: int = 0
+    ccache_misses: int = 0
+
+    @property
+    def wall(self):
+        return self.end - self.start
+
+
+def read_stages(path: Path, end: float) -> List[Stage]:
+    """Read the stage markers written by the Makefile's stage macro. A stage
+    lasts until the next stage of the same target starts or until its end
+    marker, whichever comes first. Stages without either last until the end of
+    the job. The end marker also has the exit status of the stage."""
+    marks = []
+    if path.exists():
+        for line in path.read_text().splitlines():
+            parts = line.split()
+            if len(parts) == 3:
+                marks.append((float(parts[2]), parts[0], parts[1], 0))
+            elif len(parts) == 4 and parts[0] == "end":
+                marks.append((float(parts[2]), parts[0], parts[1],
+                               int(parts[3])))
+    marks.sort()
+    stages: List[Stage] = []
+    current: Dict[str, Stage] = {}
+    for t, name, target, status in marks:
+        if target in current:
+            stage = current.pop(target)
+            stage.end, stage.status = t, status
+        if name != "end":
+            current[target] = Stage(name, target, t, end)
+            stages.append(current[target])
+    return stages
+
+
+def ccache_summary(hits: int, misses: int) -> str:
+    rate = 100 * hits / (hits + misses) if hits or misses else 0
+    return f"{hits} hits, {misses} misses ({rate:.0f}% hit rate)"
+
+
+def exit_status(status: int) -> int:
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def run_timed(name: str, cmd: List[str], env: Optional[dict] = None,
+              stages: Optional[Path] = None, stdout=None,
+              on_output: Optional[Callable[[str], None]] = None,
+              ccache_log: Optional[Path] = None) -> JobRecord:
+    """Run the command, recording its wall time, CPU time, peak memory usage
+    and exit status. If given, the stage markers are read from the file
+    ``stages``, and ccache writes the outcome of the job's compilations to
+    ``ccache_log``. The output of the command (stdout and stderr) is written
+    to ``stdout`` if given, or passed line by line to ``on_output``."""
+    for path in (stages, ccache_log):
+        if path is not None and path.exists():
+            path.unlink()
+    if ccache_log is not None:
+        env = dict(os.environ if env is None else env,
+                   CCACHE_STATSLOG=str(ccache_log))
+    start = time.time()
+    if on_output is not None:
+        stdout = PIPE
+    stderr = None if stdout is None else STDOUT
+    proc = Popen(cmd, env=env, stdout=stdout, stderr=stderr)
+    if on_output is not None:
+        with proc.stdout:
+            for line in proc.stdout:
+                on_output(line.decode(errors="replace"))
+    _, status, usage = os.wait4(proc.pid, 0)
+    end = time.time()
+    proc.returncode = exit_status(status)
+    record = JobRecord(name, start, end, usage.ru_utime, usage.ru_stime,
+                       usage.ru_maxrss, proc.returncode)
+    if stages is not None:
+        record.stages = read_stages(stages, end)
+    if ccache_log is not None:
+        record.ccache_hits, record.ccache_misses = \
+            read_stats_log(ccache_log) or (0, 0)
+    return record
+
+
+class Recorder:
+    """Collects the job records of a build, and writes them as a Chrome trace
+    (which can be opened in chrome://tracing or https://ui.perfetto.dev)."""
+
+    def __init__(self, stages_dir: Path):
+        self.stages_dir = stages_dir
+        self.lock = threading.Lock()
+        self.records: Dict[Hashable, JobRecord] = {}
+
+    def stages_file(self, name: str) -> Path:
+        self.stages_dir.mkdir(parents=True, exist_ok=True)
+        return self.stages_dir.resolve() / (name.replace(" ", "_") + ".txt")
+
+    def add(self, key: Hashable, record: JobRecord):
+        with self.lock:
+            self.records[key] = record
+
+    def lanes(self) -> Dict[Hashable, int]:
+        """Assign each job to a row of the trace, such that the jobs in the
+        same row don't overlap."""
+        lanes, free_at = {}, []
+        for key, r in sorted(self.records.items(), key=lambda i: i[1].start):
+            for i, t in enumerate(free_at):
+                if t <= r.start:
+                    break
+            else:
+                i = len(free_at)
+                free_at.append(0.0)
+            free_at[i] = r.end
+            lanes[key] = i
+        return lanes
+
+    def write_trace(self, path: Path):
+        if not self.records:
+            return
+        origin = min(r.start for r in self.records.values())
+
+        def us(t):
+            return int(round((t - origin) * 1e6))
+
+        events = []
+        for key, lane in self.lanes().items():
+            r = self.records[key]
+            events.append({
+                "name": r.name, "cat": "job", "ph": "X", "pid": 1,
+                "tid": lane, "ts": us(r.start), "dur": us(r.end) - us(r.start),
+                "args": {"user": r.user, "sys": r.sys, "maxrss_kib": r.maxrss,
+                         "status": r.status, "ccache_hits": r.ccache_hits,
+                         "ccache_misses": r.ccache_misses},
+            })
+            for s in r.stages:
+                events.append({
+                    "name": s.name, "cat": "stage", "ph": "X", "pid": 1,
+                    "tid": lane, "ts": us(s.start),
+                    "dur": us(s.end) - us(s.start),
+                    "args": {"target": s.target, "status": s.status},
+                })
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(json.dumps({"traceEvents": events}))
+        os.replace(tmp, path)
+
+    def critical_path(self, deps: Dict[Hashable, List[Hashable]]):
+        """The chain of dependent jobs with the largest total wall time. Jobs
+        without a record (e.g. restored from the cache) count as zero."""
+        longest: Dict[Hashable, float] = {}
+        prev: Dict[Hashable, Optional[Hashable]] = {}
+
+        def visit(key):
+            if key in longest:
+                return longest[key]
+            best, best_dep = 0.0, None
+            for d in deps[key]:
+                if visit(d) > best or best_dep is None:
+                    best, best_dep = longest[d], d
+            r = self.records.get(key)
+            longest[key] = best + (r.wall if r else 0.0)
+            prev[key] = best_dep
+            return longest[key]
+
+        if not deps:
+            return []
+        key = max(deps, key=visit)
+        path = []
+        while key is not None:
+            path.append(key)
+            key = prev[key]
+        return path[::-1]
+
+    def summary(self, deps: Dict[Hashable, List[Hashable]]) -> str:
+        """A table with the timings of the jobs on the critical path."""
+        path = self.critical_path(deps)
+        rows = [("Job", "Wall", "User", "Sys", "Max RSS", "Status", "Stages")]
+        total = 0.0
+        for key in path:
+            r = self.records.get(key)
+            if r is None:
+                rows.append((str(key), "-", "-", "-", "-", "-", ""))
+                continue
+            total += r.wall
+            per_stage: Dict[str, float] = {}
+            for s in r.stages:
+                duration = s.end - s.start
+                per_stage[s.name] = per_stage.get(s.name, 0.0) + duration
+            stages = ", ".join(f"{n} {t:.0f}s" for n, t in per_stage.items())
+            rows.append((r.name, f"{r.wall:.1f}s", f"{r.user:.1f}s",
+                         f"{r.sys:.1f}s", f"{r.maxrss // 1024} MiB",
+                         str(r.status), stages))
+        widths = [max(len(c) for c in col) for col in zip(*rows)]
+        lines = ["Critical path:"]
+        for row in rows:
+            lines.append("  ".join(c.ljust(w) for c, w in zip(row, widths)))
+        lines.append(f"Total: {total:.1f}s")
+        hits = sum(r.ccache_hits for r in self.records.values())
+        misses = sum(r.ccache_misses for r in self.records.values())
+        if hits or misses:
+            lines.append(f"ccache (all jobs): {ccache_summary(hits, misses)}")
+        return "\n".join(l.rstrip() for l in lines)
+
+
+class DurationDB:
+    """The wall times of the last successful run of previous jobs, by the name
+    of the job (target, triple and version, e.g. "python
+    aarch64-rpi3-linux-gnu 3.11.8"), used to predict the durations of the
+    jobs of the next build."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.durations: Dict[str, float] = {}
+        if path.exists():
+            self.durations = json.loads(path.read_text())
+
+    def estimate(self, name: str) -> Optional[float]:
+        """The previous duration of the job, or else the mean duration of the
+        same target for other triples and versions, if any."""
+        if name in self.durations:
+            return self.durations[name]
+        target = name.split(" ")[0]
+        same = [t for n, t in self.durations.items()
+                if n.split(" ")[0] == target]
+        return sum(same) / len(same) if same else None
+
+    def update(self, records: Iterable[JobRecord]):
+        for r in records:
+            if r.status == 0:
+                self.durations[r.name] = round(r.wall, 1)
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps(self.durations, indent=1, sort_keys=True))
+        os.replace(tmp, self.path)